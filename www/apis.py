@@ -5,11 +5,11 @@
 JSON API definition.
 '''
 
-import json, logging, inspect, functools
+import json, logging, inspect, functools, base64
 
 
 class Page(object):
-    def __init__(self,item_count,page_index=1,page_size=10):
+    def __init__(self,item_count,page_index=1,page_size=10,cursor=None):
         # item_count 为 blogs 条数
         self.item_count = item_count
         # 一页 blogs 条数
@@ -20,20 +20,46 @@ class Page(object):
             self.offset = 0
             self.limit = 0
             self.page_index = 1
+            cursor = None
         else:
             self.page_index = page_index
             self.offset = self.page_size * ( page_index -1 )
-            self.limit = self.page_size * page_index
+            self.limit = self.page_size
         # 是否还有下一页
         self.has_next = self.page_index < self.page_count
         # 是否有前一页
         self.has_previous = self.page_index > 1
-    
+        # 游标分页: cursor 为上一页最后一条记录的游标, after 为解码后的(create_at,id)
+        self.cursor = cursor or None
+        self.after = decode_cursor(cursor) if cursor else None
+        # 下一页的游标,由 set_next 根据本页数据生成
+        self.next_cursor = None
+
+    #根据本页最后一条记录生成下一页游标
+    def set_next(self,items):
+        if self.has_next and items:
+            last = items[-1]
+            self.next_cursor = encode_cursor(last.create_at,last.id)
+
     def __str__(self):
-        return 'item_count:%s,page_count:%s,page_index:%s,page_size:%s,offset:%slimit:%s'%(self.item_count,self.page_count,self.page_index,self.page_size,self.offset,self.limit)
+        return 'item_count:%s,page_count:%s,page_index:%s,page_size:%s,offset:%slimit:%s,cursor:%s'%(self.item_count,self.page_count,self.page_index,self.page_size,self.offset,self.limit,self.cursor)
 
     __repr__ = __str__
 
+#将(create_at,id)编码为不透明的游标字符串
+def encode_cursor(create_at,id):
+    s = json.dumps([create_at,id],separators=(',',':'))
+    return base64.urlsafe_b64encode(s.encode('utf-8')).decode('ascii').rstrip('=')
+
+#解码游标字符串,格式不正确时抛出 APIValueError
+def decode_cursor(cursor):
+    try:
+        s = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        create_at, id = json.loads(s.decode('utf-8'))
+        return (float(create_at),id)
+    except Exception:
+        raise APIValueError('cursor','Invalid cursor.')
+
 
 class APIError(Exception):
     '''
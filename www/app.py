@@ -6,9 +6,12 @@ from aiohttp import web
 from datetime import datetime
 from jinja2 import Environment,FileSystemLoader
 from handlers import cookie2user,COOKIE_NAME
+from config import configs
 
 from coroweb import add_routes,add_static
 import orm
+from search import blog_index
+from ids import node_lease
 
 import logging
 logging.basicConfig(format='%(asctime)s: %(message)s',datefmt='%y-%b-%d %H:%M:%S',level=logging.INFO)
@@ -72,6 +75,20 @@ async def logger_factory(app,handler):
         return (await handler(request))
     return logger
 
+#为每个请求设置时限,之后的数据库查询超出时限时被中止,返回 504
+async def deadline_factory(app,handler):
+    async def deadline(request):
+        timeout = getattr(request.match_info.handler,'timeout',None) or configs.request.timeout
+        token = orm.set_deadline(timeout)
+        try:
+            return (await handler(request))
+        except orm.DeadlineExceeded:
+            logging.warning('Request timeout:%s %s'%(request.method,request.path))
+            return web.HTTPGatewayTimeout()
+        finally:
+            orm.reset_deadline(token)
+    return deadline
+
 async def data_factory(app, handler):
     async def parse_data(request):
         if request.method == 'POST':
@@ -84,13 +101,26 @@ async def data_factory(app, handler):
         return (await handler(request))
     return parse_data
 
+#为每个请求开启 identity map,同一请求内多次 find 同一记录只查询一次
+async def identity_factory(app,handler):
+    async def identity(request):
+        token = orm.begin_identity_map()
+        try:
+            return (await handler(request))
+        finally:
+            orm.end_identity_map(token)
+    return identity
+
 #提取并解析cookie并绑定到request对象
 async def auth_factory(app,handler):
     async def auth(request):
         logging.info('check user:%s %s'%(request.method,request.path))
         request.__user__ = None
         cookie_str = request.cookies.get(COOKIE_NAME)
-        if cookie_str:
+        #静态文件不需要用户信息
+        if cookie_str and not request.path.startswith('/static/'):
+            #按用户区分会话,写入后短时间内该用户的读请求发往主库
+            orm.bind_session(cookie_str.split('-')[0])
             user = await cookie2user(cookie_str)
             #从客户端cookies读到的用户设置为当前用户
             if user:
@@ -102,6 +132,22 @@ async def auth_factory(app,handler):
         return ( await handler(request) )
     return auth
 
+#JavaScript 只能精确表示 2**53 以内的整数,更大的整数(如 64 位 id)在 json 中以字符串输出
+_MAX_SAFE_INTEGER = 2**53 - 1
+
+def js_safe(o):
+    if isinstance(o,int) and not isinstance(o,bool):
+        return str(o) if abs(o) > _MAX_SAFE_INTEGER else o
+    if isinstance(o,orm.Model):
+        o = dict(o)
+    if isinstance(o,dict):
+        return dict((k,js_safe(v)) for k,v in o.items())
+    if isinstance(o,(list,tuple)):
+        return [js_safe(v) for v in o]
+    if hasattr(o,'__dict__'):
+        return js_safe(o.__dict__)
+    return o
+
 #视图函数处理后的结果，进行最终处理
 async def response_factory(app,handler):
     async def response(request):
@@ -121,10 +167,13 @@ async def response_factory(app,handler):
             resp = web.Response(body=r.encode('utf-8'))
             resp.content_type = 'text/html;charset=utf-8'
             return resp
+        #模型实例按其映射视图以json形式返回
+        if isinstance(r, orm.Model):
+            r = dict(r)
         if isinstance(r, dict):
             template = r.get('__template__',None)
             if template is None:
-                resp = web.Response(body=json.dumps(r, ensure_ascii=False, default=lambda o: o.__dict__).encode('utf-8'))
+                resp = web.Response(body=json.dumps(js_safe(r), ensure_ascii=False).encode('utf-8'))
                 resp.content_type = 'application/json;charset=utf-8'
                 return resp
             else:
@@ -146,9 +195,12 @@ async def response_factory(app,handler):
     return response
 
 async def init(loop):
-    await orm.create_pool(loop=loop, host='127.0.0.1', port=3306, user='root', password='Yxt123456!', db='awesome')
+    await orm.create_pool(loop=loop, **configs.db)
+    await node_lease.start(**configs.ids)
+    orm.start_counter_reconciler(loop)
+    await blog_index.start(path=configs.search.snapshot,interval=configs.search.interval)
     app = web.Application(loop=loop, middlewares=[
-        logger_factory,auth_factory,response_factory
+        logger_factory,deadline_factory,identity_factory,auth_factory,response_factory
     ])
     init_jinja2(app, filters=dict(datetime=datetime_filter))
     add_routes(app, 'handlers')
@@ -157,6 +209,18 @@ async def init(loop):
     logging.info('server started at http://127.0.0.1:9000...')
     return srv
 
+#退出前写入排队的评论,保存搜索索引快照,释放 id 节点,关闭连接池
+async def shutdown():
+    await orm.flush_writers()
+    await blog_index.save_snapshot(shutdown=True)
+    await node_lease.stop()
+    await orm.close_pool()
+
 loop = asyncio.get_event_loop()
 loop.run_until_complete(init(loop))
-loop.run_forever()
+try:
+    loop.run_forever()
+except KeyboardInterrupt:
+    pass
+finally:
+    loop.run_until_complete(shutdown())
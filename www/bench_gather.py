@@ -0,0 +1,81 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''
+    比较列表页(index、api_blogs)的两条查询依次执行与用 orm.gather 并发执行的延迟
+    使用 SQLite 后端: 每个只读连接在自己的线程中执行,两条查询可以同时进行
+    记录数计数器和查询结果缓存在每次请求前清空,测的是两条查询都访问数据库时的延迟
+    SQLite 没有网络往返,rtt 给出时每条语句额外等待 rtt 毫秒,模拟访问 MySQL 时的网络延迟
+    用法: python3 bench_gather.py [博客数] [请求数] [rtt毫秒,默认依次测 0 和 1]
+'''
+
+import asyncio,os,sys,tempfile,time
+import logging
+logging.disable(logging.WARNING)
+import orm,orm_sqlite
+from apis import Page
+from models import Blog
+
+_execute = orm_sqlite.Cursor.execute
+
+#让每条语句的执行多等待 rtt 毫秒(请求和响应各一半)
+def simulate_rtt(rtt):
+    async def execute(self,sql,args=None):
+        await asyncio.sleep(rtt / 2000)
+        res = await _execute(self,sql,args)
+        await asyncio.sleep(rtt / 2000)
+        return res
+    orm_sqlite.Cursor.execute = execute if rtt else _execute
+
+#插入 n 篇博客
+async def fill(n):
+    rows = [dict(user_id='u%s'%(i % 10),user_name='user',user_image='http://img/%s'%i,name='blog %s'%i,summary='summary %s'%i,content='content ' * 50,create_at=1500000000.0 + i) for i in range(n)]
+    for i in range(0,n,1000):
+        await Blog.save_many(rows[i:i+1000],batch_size=100)
+
+#列表页的两条查询: 记录总数和第 page_index 页(与 handlers.find_page 的偏移分页相同)
+def queries(page_index):
+    page = Page(page_index * 10,page_index)
+    return Blog._count(),Blog.findall(orderby='create_at desc,id desc',limit=(page.offset,page.limit),cache=False)
+
+async def serial(page_index):
+    count,find = queries(page_index)
+    return await count,await find
+
+async def concurrent(page_index):
+    return await orm.gather(*queries(page_index))
+
+#返回每次请求的延迟(毫秒),已排序
+async def measure(fn,requests):
+    latencies = []
+    for i in range(requests):
+        orm._counter.forget(Blog.__table__)
+        orm._results.clear()
+        start = time.perf_counter()
+        await fn(i % 50 + 1)
+        latencies.append((time.perf_counter() - start) * 1000)
+    return sorted(latencies)
+
+async def main(n,requests,rtts):
+    path = os.path.join(tempfile.mkdtemp(),'bench.db')
+    schema = os.path.join(os.path.dirname(os.path.abspath(__file__)),'schema.sql')
+    await orm.create_pool(None,backend='sqlite',db=path,schema=schema,maxsize=4)
+    try:
+        await fill(n)
+        print('blogs: %s  requests: %s' % (n,requests))
+        #预热连接和页面缓存
+        await measure(serial,10)
+        for rtt in rtts:
+            simulate_rtt(rtt)
+            for name,fn in (('serial',serial),('gather',concurrent)):
+                latencies = await measure(fn,requests)
+                print('rtt %s ms  %-7s mean: %7.2f ms   p50: %7.2f ms   p95: %7.2f ms' % (rtt,name,sum(latencies) / requests,latencies[requests // 2],latencies[requests * 95 // 100]))
+    finally:
+        simulate_rtt(0)
+        await orm.close_pool()
+
+if __name__ == '__main__':
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 50000
+    requests = int(sys.argv[2]) if len(sys.argv) > 2 else 200
+    rtts = [float(sys.argv[3])] if len(sys.argv) > 3 else [0,1]
+    asyncio.run(main(n,requests,rtts))
@@ -0,0 +1,67 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''
+    比较 slot 模型与原来基于 dict 的模型在内存占用和构造耗时上的差别
+    用法: python3 bench_models.py [行数]
+'''
+
+import sys,time,tracemalloc
+import logging
+logging.disable(logging.INFO)
+from models import Blog
+
+#原来的模型: 继承 dict,通过 __getattr__ 访问字段
+class DictBlog(dict):
+    def __init__(self,**kw):
+        super(DictBlog,self).__init__(**kw)
+
+    def __setattr__(self,key,value):
+        self[key] = value
+
+    def __getattr__(self,key):
+        try:
+            return self[key]
+        except:
+            raise AttributeError('\'Model\' object has no attribution %s'%key)
+
+#构造 n 行 blogs 表的查询结果(元组)
+def make_rows(n):
+    content = 'content ' * 20
+    return [('%050d'%i,'%050d'%(i % 10),'user','http://img/%s'%i,'blog %s'%i,'summary %s'%i,content,1500000000.0 + i) for i in range(n)]
+
+#原来的构造方式: DictCursor 先为每行生成 dict,再 cls(**r) 复制一遍
+def load_dict(rows):
+    columns = Blog.__columns__
+    return [DictBlog(**r) for r in [dict(zip(columns,row)) for row in rows]]
+
+#现在的构造方式: 元组行直接写入 slot
+def load_slots(rows):
+    load = Blog._load
+    return [load(row) for row in rows]
+
+#返回 (耗时秒数, 结果占用的内存字节数)
+def measure(fn,rows):
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    start = time.perf_counter()
+    models = fn(rows)
+    elapsed = time.perf_counter() - start
+    size = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    #读取一遍字段,确认两种模型都可用
+    for m in models:
+        m.name
+    return elapsed,size
+
+if __name__ == '__main__':
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    rows = make_rows(n)
+    print('rows: %s' % n)
+    for name,fn in (('dict',load_dict),('slots',load_slots)):
+        #计时时关闭 tracemalloc,避免其开销影响结果
+        start = time.perf_counter()
+        fn(rows)
+        elapsed = time.perf_counter() - start
+        _,size = measure(fn,rows)
+        print('%-6s construct: %8.1f ms  %6.2f us/row   memory: %8.1f KB  %6.1f B/row' % (name,elapsed * 1000,elapsed * 1e6 / n,size / 1024,size / n))
@@ -7,13 +7,42 @@
 
 configs = {
     'db':{
+        #数据库后端: 'mysql',或 'sqlite'(单机部署,db 为数据库文件路径,可用 'schema':'schema.sql' 在启动时建表)
+        'backend':'mysql',
         'host':'127.0.0.1',
         'port':3306,
         'user':'root',
         'password':'Yxt123456!',
-        'db':'awesome'
+        'db':'awesome',
+        #连接数在 minsize 和 maxsize 之间按获取连接的等待时间调整,启动时预先建立 prewarm 个连接,每 ping 秒检查空闲连接
+        'minsize':2,
+        'maxsize':20,
+        'prewarm':5,
+        'ping':30,
+        #只读副本,如 [{'host':'10.0.0.2'}],未给出的参数沿用主库配置
+        'readers':[],
+        #写入后多少秒内该会话的读请求仍发往主库
+        'sticky':5,
+        #查询结果缓存: 最多缓存的结果数、过期时间(秒)、可缓存的最大行数
+        'results':{'size':2000,'ttl':60,'maxrows':1000},
+        #慢查询日志: 阈值(毫秒)、保留条数、是否抓取执行计划
+        'slow':{'threshold':200,'size':100,'explain':True}
+    },
+    #请求时限(秒),超出时正在执行的查询被中止; 单个 URL 可用 @get(path,timeout=...) 另行设置
+    'request':{
+        'timeout':10
     },
     'session':{
         'secret':'AWESOME'
+    },
+    #64 位 id 的节点号: node 为 None 时启动时从 id_nodes 表申请,ttl 秒内没有续约的节点可被其他进程接管
+    'ids':{
+        'node':None,
+        'ttl':60
+    },
+    #全文搜索: 索引快照文件,以及写回快照的间隔(秒)
+    'search':{
+        'snapshot':'search_index.json',
+        'interval':300
     }
 }
\ No newline at end of file
@@ -14,25 +14,27 @@ logging.basicConfig(format='%(asctime)s: %(message)s',datefmt='%y-%b-%d %H:%M:%S
     建立视图函数装饰器，用于存储，附带URL信息
 '''
 
-#Get 方法装饰器
-def get(path):
+#Get 方法装饰器, timeout 为该 URL 的请求时限(秒),不给出时使用配置中的默认值
+def get(path,timeout=None):
     def decorator(func):
         @functools.wraps(func)
         def wrapper(*args, **kw):
             return func(*args, **kw)
         wrapper.__method__ = 'GET'
         wrapper.__route__ = path
+        wrapper.__timeout__ = timeout
         return wrapper
     return decorator
 
 #Post 方法装饰器
-def post(path):
+def post(path,timeout=None):
     def decorator(func):
         @functools.wraps(func)
         def wrapper(*args, **kw):
             return func(*args, **kw)
         wrapper.__method__ = 'POST'
         wrapper.__route__ = path
+        wrapper.__timeout__ = timeout
         return wrapper
     return decorator
 
@@ -105,6 +107,7 @@ class RequestHandler(object):
     def __init__(self, app, fn):
         self._app = app
         self._func = fn
+        self.timeout = getattr(fn,'__timeout__',None)     #请求时限(秒)
         self._has_request_arg = has_request_arg(fn)         #是否有 'request' 参数
         self._has_var_kw_arg = has_var_kw_arg(fn)         #是否有关键字参数
         self._has_named_kw_args = has_named_kw_args(fn)     #是否有命名关键字参数
@@ -6,8 +6,11 @@ from aiohttp import web
 import markdown2
 from coroweb import get, post
 from apis import APIValueError, APIResourceNotFoundError,APIError,APIPermissionError,Page
-from models import User, Comment, Blog, next_id
+from models import User, Comment, Blog, next_uid
 from config import configs,toDict
+import orm
+from search import blog_index
+from ids import node_lease
 import logging
 logging.basicConfig(level=logging.INFO,format='%(asctime)s: %(message)s',datefmt='%y-%b-%d %H:%M:%S')
 
@@ -22,6 +25,13 @@ def check_admin(request):
     if request.__user__ is None or not request.__user__.admin:
         raise APIPermissionError()
 
+#URL 中的 id 按模型主键的类型转换,格式不对时视为记录不存在
+def get_pk(model,id):
+    try:
+        return model.cast(model.__primary_key__,id)
+    except ValueError:
+        raise APIResourceNotFoundError(model.__name__)
+
 def get_page_index(page_str):
     p = 1
     try:
@@ -33,6 +43,29 @@ def get_page_index(page_str):
     return p
 
 
+#取出一页记录: 带游标时按(create_at,id)做seek分页,否则按页码偏移
+async def find_page(model,page):
+    if page.after is not None:
+        items = await model.findseek('create_at',after=page.after,limit=page.limit)
+    else:
+        items = await model.findall(orderby='create_at desc,id desc', limit=(page.offset, page.limit))
+    page.set_next(items)
+    return items
+
+#同时查询记录总数和本页记录,返回 (Page, 记录)
+#先假设页码在范围内按页码取数据,页码超出范围被修正时再按修正后的 Page 查询一次
+async def count_and_find(model,page_index,cursor=None):
+    guess = Page(page_index * 10, page_index, cursor=cursor)
+    num, items = await orm.gather(model.count(), find_page(model, guess))
+    page = Page(num, page_index, cursor=cursor)
+    if num == 0:
+        return page, []
+    if page.offset != guess.offset or page.after != guess.after:
+        return page, await find_page(model, page)
+    page.set_next(items)
+    return page, items
+
+
 def user2cookie(user, max_age):
     '''
     Generate cookie str by user.
@@ -43,12 +76,28 @@ def user2cookie(user, max_age):
     L = [user.id, expires, hashlib.sha1(s.encode('utf-8')).hexdigest()]
     return '-'.join(L)
 
+#已验证的会话: cookie -> 用户记录,过期时间不超过 cookie 中的 expires 和 ttl;
+#缓存只在本进程内失效,ttl 限定用户记录在其他进程中变化(如删除用户)后旧会话仍可使用的最长时间,与 User 的行缓存相同
+_session_cache = orm.LRUCache(maxsize=10000,ttl=600)
+
+#使某个 cookie 对应的会话缓存失效(退出登录时调用)
+def drop_session(cookie_str):
+    if cookie_str:
+        _session_cache.pop(cookie_str)
+
+#会话缓存统计
+def session_stats():
+    return _session_cache.stats()
+
 async def cookie2user(cookie_str):
     '''
     Parse cookie and load user if cookie is valid.
     '''
     if not cookie_str:
         return None
+    user = _session_cache.get(cookie_str)
+    if user is not None:
+        return User(**user)
     try:
         L = cookie_str.split('-')
         if len(L) != 3:
@@ -64,6 +113,8 @@ async def cookie2user(cookie_str):
             logging.info('invalid sha1')
             return None
         user.password = '******'
+        #缓存期间的请求无需再查询数据库和校验 sha1
+        _session_cache.set(cookie_str, dict(user), min(int(expires) - time.time(), _session_cache.ttl))
         return user
     except Exception as e:
         logging.exception(e)
@@ -75,15 +126,9 @@ def text2html(text):
 
 #首页
 @get('/')
-async def index(request,*, page='1'):
+async def index(request,*, page='1', cursor=None):
     page_index = get_page_index(page)
-    num = await Blog.findnum('count(id)')
-    num = num[0].get('count(id)',None)
-    page = Page(num)
-    if num == 0:
-        blogs = []
-    else:
-        blogs = await Blog.findall(orderby='create_at desc', limit=(page.offset, page.limit))
+    page, blogs = await count_and_find(Blog, page_index, cursor)
     return {
         '__template__': 'blogs.html',
         'page': page,
@@ -94,8 +139,8 @@ async def index(request,*, page='1'):
 #点击某个blog，进入该blog的主页面
 @get('/blog/{id}')
 async def get_blog(id,request):
-    blog = await Blog.find(id)
-    comments = await Comment.findall(where='blog_id=?',args=[id],orderby='create_at desc')
+    id = get_pk(Blog,id)
+    blog, comments = await orm.gather(Blog.find(id), Comment.findall(where='blog_id=?',args=[id],orderby='create_at desc'))
     for c in comments:
         c.html_content = text2html(c.content)
     blog.html_content = markdown2.markdown(blog.content)
@@ -132,7 +177,7 @@ async def api_register_user(*, email, name, passwd):
     users = await User.findall(selectField='email',where='email=?',args=[email])
     if len(users) > 0:
         raise APIError('register:failed', 'email', 'Email is already in use.')
-    uid = next_id()
+    uid = next_uid()
     sha1_passwd = '%s:%s' % (uid, passwd)
     user = User(id=uid, name=name.strip(), email=email, password=hashlib.sha1(sha1_passwd.encode('utf-8')).hexdigest(), image='http://www.gravatar.com/avatar/%s?d=mm&s=120' % hashlib.md5(email.encode('utf-8')).hexdigest())
     await user.save()
@@ -141,7 +186,7 @@ async def api_register_user(*, email, name, passwd):
     r.set_cookie(COOKIE_NAME, user2cookie(user, 86400), max_age=86400, httponly=True)
     user.password = '******'
     r.content_type = 'application/json'
-    r.body = json.dumps(user, ensure_ascii=False).encode('utf-8')
+    r.body = json.dumps(user, ensure_ascii=False, default=dict).encode('utf-8')
     return r
 
 #登录API
@@ -167,7 +212,7 @@ async def authenticate(*, email, passwd):
     r.set_cookie(COOKIE_NAME, user2cookie(user, 86400), max_age=86400, httponly=True)
     user.password = '******'
     r.content_type = 'application/json'
-    r.body = json.dumps(user, ensure_ascii=False).encode('utf-8')
+    r.body = json.dumps(user, ensure_ascii=False, default=dict).encode('utf-8')
     return r
 
 #退出登录
@@ -176,6 +221,7 @@ def signout(request):
     referer = request.headers.get('Referer')
     #返回前一页或者首页
     r = web.HTTPFound(referer or '/')
+    drop_session(request.cookies.get(COOKIE_NAME))
     r.set_cookie(COOKIE_NAME, '-deleted-', max_age=0, httponly=True)
     logging.info('user signed out.')
     return r
@@ -187,19 +233,21 @@ def manage():
 
 #后台管理页，评论页
 @get('/manage/comments')
-def manage_comments(request,*, page='1'):
+def manage_comments(request,*, page='1', cursor=''):
     return {
         '__template__': 'manage_comments.html',
         'page_index': get_page_index(page),
+        'cursor': cursor,
         '__user__':request.__user__
     }
 
 #后台管理页，blog页
 @get('/manage/blogs')
-def manage_blogs(request,*,page='1'):
+def manage_blogs(request,*,page='1',cursor=''):
     return {
         '__template__':'manage_blogs.html',
         'page_index':get_page_index(page),
+        'cursor':cursor,
         '__user__':request.__user__
     }
 
@@ -225,23 +273,63 @@ def manage_edit_blog(request,*, id):
 
 #后台管理页，查看注册用户页
 @get('/manage/users')
-def manage_users(request,*, page='1'):
+def manage_users(request,*, page='1', cursor=''):
     return {
         '__template__': 'manage_users.html',
         'page_index': get_page_index(page),
+        'cursor': cursor,
+        '__user__':request.__user__
+    }
+
+#后台管理页，数据库连接池与语句执行统计页
+@get('/manage/stats')
+def manage_stats(request):
+    return {
+        '__template__': 'manage_stats.html',
         '__user__':request.__user__
     }
 
+#以json形式返回数据库连接池、语句执行和各级缓存的统计
+@get('/api/stats')
+def api_stats(request):
+    check_admin(request)
+    return dict(
+        pools=orm.pool_stats(),
+        queries=orm.query_stats(),
+        statements=orm.statement_stats(),
+        counters=orm.counter_stats(),
+        caches=orm.cache_stats(),
+        results=orm.result_cache_stats(),
+        loaders=orm.loader_stats(),
+        writers=orm.writer_stats(),
+        coalesce=orm.coalesce_stats(),
+        search=blog_index.stats(),
+        ids=node_lease.stats(),
+        deadlines=orm.deadline_stats(),
+        sessions=session_stats()
+    )
+
+#后台管理页，语句统计与慢查询日志
+@get('/manage/queries')
+def manage_queries(request):
+    return {
+        '__template__': 'manage_queries.html',
+        '__user__':request.__user__
+    }
+
+#以json形式返回各类语句的执行统计和最近的慢查询(含执行计划)
+@get('/api/queries')
+def api_queries(request):
+    check_admin(request)
+    return dict(queries=orm.query_stats(),**orm.slow_queries())
+
 #获取评论,以json文件形式显示
 @get('/api/comments')
-async def api_comments(*, page='1'):
+async def api_comments(*, page='1', cursor=None):
     page_index = get_page_index(page)
-    num = await Comment.findnum('count(id)')
-    num = num[0].get('count(id)',None)
-    p = Page(num, page_index)
-    if num == 0:
+    p, comments = await count_and_find(Comment, page_index, cursor)
+    if p.item_count == 0:
         return dict(page=p, comments=())
-    comments = await Comment.findall(orderby='create_at desc', limit=(p.offset, p.limit))
     return dict(page=p, comments=comments)
 
 #创建评论
@@ -256,7 +344,8 @@ async def api_create_comment(id, request, *, content):
     if blog is None:
         raise APIResourceNotFoundError('Blog')
     comment = Comment(blog_id=blog.id, user_id=user.id, user_name=user.name, user_image=user.image, content=content.strip())
-    await comment.save()
+    #与同一时刻的其他评论合并写入
+    await comment.save_batched()
     return comment
 
 #后台管理，删除评论
@@ -271,30 +360,65 @@ async def api_delete_comments(id, request):
 
 #以json形式返回所有注册用户
 @get('/api/users')
-async def api_get_users(*, page='1'):
+async def api_get_users(*, page='1', cursor=None):
     page_index = get_page_index(page)
-    num = await User.findnum('count(id)')
-    num = num[0].get('count(id)',None)
-    p = Page(num, page_index)
-    if num == 0:
+    p, users = await count_and_find(User, page_index, cursor)
+    if p.item_count == 0:
         return dict(page=p, users=())
-    users = await User.findall(orderby='create_at desc', limit=(p.offset, p.limit))
     for u in users:
         u.password= '******'
     return dict(page=p, users=users)
 
+#可导出的表
+_EXPORT_MODELS = dict(blogs=Blog,comments=Comment,users=User)
+
+#后台管理,以NDJSON格式流式导出整张表
+@get('/api/export/{table}',timeout=600)
+async def api_export(table,request):
+    check_admin(request)
+    model = _EXPORT_MODELS.get(table,None)
+    if model is None:
+        raise APIResourceNotFoundError('table')
+    r = web.StreamResponse()
+    r.content_type = 'application/x-ndjson'
+    r.charset = 'utf-8'
+    r.headers['Content-Disposition'] = 'attachment; filename="%s.ndjson"'%table
+    await r.prepare(request)
+    lines = []
+    async for m in model.iter_all(orderby='create_at'):
+        if model is User:
+            m.password = '******'
+        lines.append(json.dumps(m,ensure_ascii=False,default=dict))
+        #攒够一批再写出,减少写操作次数
+        if len(lines) >= 100:
+            await r.write(('\n'.join(lines)+'\n').encode('utf-8'))
+            lines = []
+    if lines:
+        await r.write(('\n'.join(lines)+'\n').encode('utf-8'))
+    await r.write_eof()
+    return r
+
 #以json形式显示所有blog
 @get('/api/blogs')
-async def api_blogs(*,page='1'):
+async def api_blogs(*,page='1',cursor=None):
     page_index = get_page_index(page)
-    num = await Blog.findnum(selectField='count(id)')
-    num = num[0].get('count(id)',None)
-    p = Page(num,page_index)
-    if num == 0:
+    p, blogs = await count_and_find(Blog, page_index, cursor)
+    if p.item_count == 0:
         return dict(page=0,blog=())
-    blogs = await Blog.findall(orderby='create_at desc', limit=(p.offset, p.limit))
     return dict(page=p, blogs=blogs)
 
+#全文搜索博客,按相关度排序
+@get('/api/search')
+def api_search(*,q='',page='1'):
+    q = q.strip()
+    if not q:
+        raise APIValueError('q','search query cannot be empty.')
+    scores = blog_index.match(q)
+    p = Page(len(scores), get_page_index(page))
+    if p.item_count == 0:
+        return dict(page=p, blogs=())
+    return dict(page=p, blogs=blog_index.top(scores, p.offset, p.limit))
+
 #以json形式显示某个id的blog
 @get('/api/blogs/{id}')
 async def api_get_blog(*,id):
@@ -340,5 +464,8 @@ async def api_delete_blog(request, *, id):
     blog = await Blog.find(id)
     if blog is None:
         raise APIResourceNotFoundError('Blogs')
-    await blog.remove(pk=id)
+    #日志和它的评论在同一个事务中删除
+    async with orm.transaction():
+        await Comment.removeall('blog_id=?', [blog.id])
+        await blog.remove(pk=blog.id)
     return dict(id=id)
\ No newline at end of file
@@ -0,0 +1,145 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''
+    64 位有序 id 的节点管理与旧数据转换
+    节点租约: 每个进程启动时在 id_nodes 表中占用一个空闲(或心跳已过期)的节点号,定期续约,退出时释放,
+    这样多个进程(或多台机器)同时生成的 id 不会重复
+    转换: 把 blogs/comments 原来的字符串 id 按 create_at 换成有序的整数 id,并同步修改 comments.blog_id
+'''
+
+import asyncio,os,socket,time
+import logging
+import orm
+from models import Blog,Comment,IdNode
+
+#节点租约
+class NodeLease(object):
+    def __init__(self):
+        self.node = None
+        self.owner = None
+        self.ttl = 60
+        self.heartbeat = 0
+        self.renewals = 0
+        #租约过期被其他进程占用后重新申请的次数
+        self.lost = 0
+        self._task = None
+
+    #node 给出时直接使用该节点号(由部署保证各进程不同),否则从 id_nodes 表申请; 租约 ttl 秒内没有续约即视为失效
+    async def start(self,node=None,ttl=60):
+        self.ttl = ttl
+        if node is not None:
+            self.node = node
+            orm.set_id_node(node)
+            logging.info('id node %s (configured)'%node)
+            return
+        self.owner = '%s:%s'%(socket.gethostname(),os.getpid())
+        await self._claim()
+        self._task = asyncio.ensure_future(self._renew_loop())
+
+    #占用第一个空闲或已过期的节点号; 最后一个节点号保留给没有租约的进程
+    async def _claim(self):
+        now = time.time()
+        leases = dict((n.node,n) for n in await IdNode.findall(cache=False))
+        for node in range(orm.MAX_NODE):
+            lease = leases.get(node,None)
+            if lease is None:
+                try:
+                    await orm.execute('insert into id_nodes(node,owner,heartbeat)values (?,?,?)',[node,self.owner,now])
+                except Exception as e:
+                    #同时被其他进程占用
+                    logging.info('id node %s is taken: %s'%(node,e))
+                    continue
+            elif lease.heartbeat < now - self.ttl:
+                #以原心跳时间为条件更新,多个进程同时接管时只有一个成功
+                if await orm.execute('update id_nodes set owner=?,heartbeat=? where node=? and heartbeat=?',[self.owner,now,node,lease.heartbeat]) != 1:
+                    continue
+            else:
+                continue
+            self.node = node
+            self.heartbeat = now
+            #心跳超过 ttl 后其他进程即可接管,本进程同时停止生成 id
+            orm.set_id_node(node,expire=now + self.ttl)
+            logging.info('id node %s leased by %s'%(node,self.owner))
+            return
+        raise RuntimeError('no free id node in id_nodes')
+
+    async def renew(self):
+        now = time.time()
+        if await orm.execute('update id_nodes set heartbeat=? where node=? and owner=?',[now,self.node,self.owner]) == 1:
+            self.heartbeat = now
+            self.renewals += 1
+            orm.set_id_expire(now + self.ttl)
+            return
+        #续约中断过久,节点号已被其他进程接管
+        self.lost += 1
+        logging.error('id node %s was taken over, claiming a new one'%self.node)
+        await self._claim()
+
+    async def _renew_loop(self):
+        while True:
+            await asyncio.sleep(self.ttl / 3)
+            try:
+                await self.renew()
+            except Exception as e:
+                logging.warning('failed to renew id node %s: %s'%(self.node,e))
+
+    #停止续约并释放节点号
+    async def stop(self):
+        if self._task is None:
+            return
+        self._task.cancel()
+        self._task = None
+        await orm.execute('delete from id_nodes where node=? and owner=?',[self.node,self.owner])
+
+    def stats(self):
+        return dict(orm.id_stats(),owner=self.owner,renewals=self.renewals,lost=self.lost,age=round(time.time() - self.heartbeat,1) if self.owner else None)
+
+#本进程的节点租约
+node_lease = NodeLease()
+
+#*********************************** Convert **************************************#*******
+
+#是否已是整数 id
+def _is_int(id):
+    return isinstance(id,int) or (isinstance(id,str) and id.isdigit())
+
+#按 create_at 顺序为表中的每条记录分配新 id,已是整数的保持不变,返回 (旧id(字符串形式) -> 新id,create_at 早于 _ID_EPOCH 的记录数)
+#每张表使用单独的生成器: 生成器的时间不会回退,共用时一张表中早于另一张表最新记录的行都会得到那条记录的时间
+async def _plan(model):
+    #新 id 的时间戳取自记录的 create_at,与当前生成的 id 不会重复
+    ids = orm.Snowflake(orm.MAX_NODE)
+    mapping = dict()
+    sql = 'select %s,create_at from %s order by create_at,%s'%(model.__primary_key__,model.__table__,model.__primary_key__)
+    async for res in orm.select_iter(sql,(),batch=1000,raw=True):
+        for old,create_at in res:
+            mapping[str(old)] = int(old) if _is_int(old) else ids.at(create_at)
+    return mapping,ids.clamped
+
+#把 blogs/comments 的字符串 id 转换为整数 id,comments.blog_id 随之修改,指向不存在的博客的评论被丢弃
+#apply 为 False 时只统计,返回 [(表,记录数,需要转换的记录数,丢弃的记录数,create_at 早于 _ID_EPOCH 的记录数)]
+async def convert_ids(apply=False):
+    blogs,blogs_clamped = await _plan(Blog)
+    comments,comments_clamped = await _plan(Comment)
+    orphans = 0
+    async for res in orm.select_iter('select blog_id from comments',(),batch=1000,raw=True):
+        orphans += sum(1 for (blog_id,) in res if str(blog_id) not in blogs)
+    report = [
+        ('blogs',len(blogs),sum(1 for k in blogs if not _is_int(k)),0,blogs_clamped),
+        ('comments',len(comments),sum(1 for k in comments if not _is_int(k)),orphans,comments_clamped)
+    ]
+    if not apply:
+        return report
+    await orm.rebuild_table(Blog,lambda r: (blogs[str(r[0])],) + tuple(r[1:]))
+    i = Comment.__columns__.index('blog_id')
+    def convert(r):
+        blog_id = blogs.get(str(r[i]),None)
+        if blog_id is None:
+            return None
+        r = list(r)
+        r[0],r[i] = comments[str(r[0])],blog_id
+        return r
+    await orm.rebuild_table(Comment,convert)
+    #重建的表补建索引
+    await orm.migrate(models=[Blog,Comment],apply=True)
+    return report
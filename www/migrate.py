@@ -0,0 +1,50 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''
+    对比模型声明的表和索引与数据库的实际结构,输出缺少的 DDL
+    用法: python3 migrate.py          (只输出 DDL)
+          python3 migrate.py --apply  (输出并执行)
+    把 blogs/comments 的字符串 id 转换为 64 位整数 id(需先停止服务):
+          python3 migrate.py --ids          (只统计)
+          python3 migrate.py --ids --apply  (转换)
+'''
+
+import asyncio,sys
+import logging
+logging.basicConfig(level=logging.WARNING)
+import orm
+#导入模型以注册所有表
+import models
+import ids
+from config import configs
+
+async def main(apply):
+    await orm.create_pool(loop=asyncio.get_event_loop(),**configs.db)
+    try:
+        ddl = await orm.migrate(apply=apply)
+    finally:
+        await orm.close_pool()
+    if not ddl:
+        print('-- schema is up to date')
+    for sql in ddl:
+        print('%s;'%sql)
+    if ddl and not apply:
+        print('-- run with --apply to execute')
+
+async def convert(apply):
+    await orm.create_pool(loop=asyncio.get_event_loop(),**configs.db)
+    try:
+        report = await ids.convert_ids(apply=apply)
+    finally:
+        await orm.close_pool()
+    for table,total,strings,orphans,clamped in report:
+        print('-- %s: %s rows, %s string ids%s'%(table,total,strings,', %s rows reference missing blogs and are dropped'%orphans if orphans else ''))
+        if clamped:
+            print('-- %s: %s rows created before 2020-01-01 get ids dated 2020-01-01'%(table,clamped))
+    if not apply:
+        print('-- run with --ids --apply to convert (stop the server first)')
+
+if __name__ == '__main__':
+    args = sys.argv[1:]
+    asyncio.get_event_loop().run_until_complete((convert if '--ids' in args else main)('--apply' in args))
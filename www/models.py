@@ -1,42 +1,60 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
-import time,uuid
-from orm import Model,IntegerField,StringField,BooleanField,TextField,FloatField
+import time
+from orm import Model,Index,IntegerField,StringField,BooleanField,TextField,FloatField,next_id
 
-def next_id():
-    return '%015d%s000'%(int(time.time()*1000),uuid.uuid4().hex)
+#用户 id 仍为字符串: 密码的摘要以用户 id 加盐,已有用户的 id 不能改变
+def next_uid():
+    return str(next_id())
 
 class User(Model):
     __table__ = 'users'
+    __cache__ = dict(size=1000,ttl=600)
 
-    id = StringField(primary_key=True,column='varchar(50)',default=next_id)
-    email = StringField(column='varchar(50)')
+    id = StringField(primary_key=True,column='varchar(50)',default=next_uid)
+    email = StringField(column='varchar(50)',unique=True)
     password = StringField(column='varchar(50)')
     admin = BooleanField()
     name = StringField(column='varchar(50)')
     image = StringField(column='varchar(500)')
-    create_at = FloatField(default=time.time)
+    create_at = FloatField(default=time.time,index=True)
 
 class Blog(Model):
     __table__ = 'blogs'
+    __cache__ = dict(size=1000,ttl=300)
+    __querycache__ = True
 
-    id = StringField(primary_key=True,default=next_id,column='varchar(50)')
+    id = IntegerField(primary_key=True,default=next_id)
     user_id = StringField(column='varchar(50)')
     user_name = StringField(column='varchar(50)')
     user_image = StringField(column='varchar(500)')
     name = StringField(column='varchar(50)')
     summary = StringField(column='varchar(200)')
-    content = TextField()
-    create_at = FloatField(default=time.time)
+    content = TextField(column='mediumtext',deferred=True)
+    create_at = FloatField(default=time.time,index=True)
 
 class Comment(Model):
     __table__ = 'comments'
-
-    id = StringField(primary_key=True,default=next_id,column='varchar(50)')
-    blog_id = StringField(column='varchar(50)')
+    __counters__ = ('blog_id',)
+    __querycache__ = True
+    #评论的插入合并为多行 insert 批量写入,见 Model.save_batched
+    __writebehind__ = dict(delay=0.005,maxbatch=100,maxqueue=1000)
+    #按博客列出评论: where blog_id=? order by create_at desc
+    __indexes__ = (Index('blog_id','create_at'),)
+
+    id = IntegerField(primary_key=True,default=next_id)
+    blog_id = IntegerField()
     user_id = StringField(column='varchar(50)')
     user_name = StringField(column='varchar(50)')
     user_image = StringField(column='varchar(500)')
-    content = TextField()
-    create_at = FloatField(default=time.time)
+    content = TextField(column='mediumtext')
+    create_at = FloatField(default=time.time,index=True)
+
+#id 节点租约: 每个进程占用一个节点号,定期续约,见 ids.py
+class IdNode(Model):
+    __table__ = 'id_nodes'
+
+    node = IntegerField(primary_key=True,column='int')
+    owner = StringField(column='varchar(100)')
+    heartbeat = FloatField()
@@ -1,18 +1,590 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
-import aiomysql,asyncio
+import aiomysql,orm_sqlite,asyncio,collections,contextvars,contextlib,functools,bisect,re,time
 import logging
 logging.basicConfig(format='%(asctime)s: %(message)s',datefmt='%y-%b-%d %H:%M:%S',level=logging.INFO)
 
 
+#*********************************** Statement Cache ******************************#*******
+
+#语句缓存: 同一条sql(或同一形状的模型查询)只构造/编译一次,并记录命中情况
+class StatementCache(object):
+    def __init__(self,maxsize=1024):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._statements = collections.OrderedDict()
+
+    #根据key取出语句,不存在时调用builder构造并缓存
+    def get(self,key,builder,*args):
+        try:
+            sql = self._statements[key]
+        except KeyError:
+            self.misses += 1
+            sql = builder(*args)
+            #超出容量时淘汰最早缓存的语句
+            if len(self._statements) >= self.maxsize:
+                self._statements.popitem(last=False)
+            self._statements[key] = sql
+            return sql
+        self.hits += 1
+        return sql
+
+    def stats(self):
+        return dict(size=len(self._statements),maxsize=self.maxsize,hits=self.hits,misses=self.misses)
+
+_statements = StatementCache()
+
+#将'?'占位符编译为数据库驱动的占位符(aiomysql 为'%s')
+def compile_sql(sql):
+    if _backend.placeholder == '?':
+        return sql
+    return _statements.get(sql,sql.replace,'?',_backend.placeholder)
+
+#语句缓存统计
+def statement_stats():
+    return _statements.stats()
+
+#*********************************** Diagnostics **********************************#*******
+
+#延迟直方图各分桶的上界(毫秒)
+_BUCKETS = (1,2,5,10,20,50,100,200,500,1000,2000,5000)
+
+#延迟直方图(毫秒)
+class Histogram(object):
+    def __init__(self):
+        self.counts = [0] * (len(_BUCKETS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self,ms):
+        self.counts[bisect.bisect_left(_BUCKETS,ms)] += 1
+        self.count += 1
+        self.total += ms
+        if ms > self.max:
+            self.max = ms
+
+    #估算分位数: 取累计次数达到该比例的分桶上界,落在最后一个分桶时取最大值
+    def percentile(self,p):
+        if not self.count:
+            return 0
+        target = self.count * p
+        seen = 0
+        for bound,n in zip(_BUCKETS,self.counts):
+            seen += n
+            if seen >= target:
+                return min(bound,round(self.max,3))
+        return round(self.max,3)
+
+    def stats(self):
+        labels = ['<=%sms'%b for b in _BUCKETS] + ['>%sms'%_BUCKETS[-1]]
+        return dict(count=self.count,total=round(self.total,3),avg=round(self.total / self.count,3) if self.count else 0,p95=self.percentile(0.95),max=round(self.max,3),buckets=list(zip(labels,self.counts)))
+
+#单类语句的统计: 执行延迟以及返回的行数
+class QueryStats(Histogram):
+    def __init__(self):
+        super(QueryStats,self).__init__()
+        self.rows = 0
+
+    def add(self,ms,rows=0):
+        super(QueryStats,self).add(ms)
+        self.rows += rows
+
+    def stats(self):
+        res = super(QueryStats,self).stats()
+        res.update(rows=self.rows,avg_rows=round(self.rows / self.count,1) if self.count else 0)
+        return res
+
+#连接池统计: 获取连接的等待时间、正在等待的协程数
+class PoolStats(object):
+    def __init__(self,name,pool):
+        self.name = name
+        self.pool = pool
+        self.waiting = 0
+        self.wait = Histogram()
+        #可同时持有的连接数上限,由 PoolManager 调整,None 表示不限制
+        self.limiter = None
+        self.manager = None
+        #当前统计周期内的等待次数、总等待时间和同时使用连接数的峰值
+        self.window_count = 0
+        self.window_wait = 0.0
+        self.peak = 0
+
+    def record_wait(self,ms):
+        self.wait.add(ms)
+        self.window_count += 1
+        self.window_wait += ms
+        in_use = self.limiter.active if self.limiter is not None else self.pool.size - self.pool.freesize
+        if in_use > self.peak:
+            self.peak = in_use
+
+    #取出并重置当前统计周期的数据,返回 (等待次数,总等待时间,峰值)
+    def take_window(self):
+        res = (self.window_count,self.window_wait,self.peak)
+        self.window_count = 0
+        self.window_wait = 0.0
+        self.peak = self.limiter.active if self.limiter is not None else 0
+        return res
+
+    def stats(self):
+        pool = self.pool
+        res = dict(name=self.name,maxsize=pool.maxsize,size=pool.size,idle=pool.freesize,in_use=pool.size - pool.freesize,waiting=self.waiting,wait=self.wait.stats())
+        if self.limiter is not None:
+            res['limit'] = self.limiter.limit
+        if self.manager is not None:
+            res.update(self.manager.stats())
+        return res
+
+#连接池 -> PoolStats
+_pool_stats = dict()
+#语句指纹 -> 执行统计,指纹过多时归入'<other>'
+_query_stats = dict()
+_QUERY_STATS_LIMIT = 500
+
+_RE_STRING = re.compile(r"'(?:[^'\\]|\\.)*'|\"(?:[^\"\\]|\\.)*\"")
+_RE_NUMBER = re.compile(r'\b\d+(?:\.\d+)?\b')
+_RE_IN_LIST = re.compile(r'\(\s*\?(?:\s*,\s*\?)+\s*\)')
+_RE_ROW_LIST = re.compile(r'\(\.\.\.\)(?:\s*,\s*\(\.\.\.\))+')
+_RE_SPACE = re.compile(r'\s+')
+
+def _fingerprint(sql):
+    sql = _RE_STRING.sub('?',sql)
+    sql = _RE_NUMBER.sub('?',sql)
+    sql = _RE_IN_LIST.sub('(...)',sql)
+    sql = _RE_ROW_LIST.sub('(...)',sql)
+    return _RE_SPACE.sub(' ',sql).strip().lower()
+
+#sql -> 指纹,与语句缓存分开,避免每次执行都计入语句缓存的命中并挤掉缓存的语句
+_fingerprints = StatementCache(maxsize=2048)
+
+#语句指纹: 去掉字面量、合并 in 列表和多行 values,同一类语句得到同一个指纹
+def fingerprint(sql):
+    return _fingerprints.get(sql,_fingerprint,sql)
+
+#记录一条语句的执行延迟和返回行数,超过慢查询阈值时记入慢查询日志
+def _record_query(sql,ms,rows=0,args=None):
+    key = fingerprint(sql)
+    hist = _query_stats.get(key,None)
+    if hist is None:
+        if len(_query_stats) >= _QUERY_STATS_LIMIT:
+            key = '<other>'
+            hist = _query_stats.get(key,None)
+        if hist is None:
+            hist = _query_stats[key] = QueryStats()
+    hist.add(ms,rows)
+    if _slow_ms is not None and ms >= _slow_ms:
+        _log_slow(sql,args,ms,rows)
+
+#慢查询阈值(毫秒), None 表示不记录
+_slow_ms = 200
+#最近的慢查询
+_slow_queries = collections.deque(maxlen=100)
+#语句指纹 -> 执行计划,同一类语句在过期前只 explain 一次
+_explains = None
+_explain_tasks = set()
+
+#设置慢查询阈值(毫秒)、保留的慢查询条数,以及是否为慢查询抓取执行计划
+def configure_slow_log(threshold=200,size=100,explain=True):
+    global _slow_ms,_slow_queries,_explains
+    _slow_ms = threshold
+    _slow_queries = collections.deque(_slow_queries,maxlen=size)
+    _explains = LRUCache(maxsize=500,ttl=600) if explain else None
+
+def _log_slow(sql,args,ms,rows):
+    key = fingerprint(sql)
+    logging.warning('slow query %.1fms rows:%s: %s'%(ms,rows,sql))
+    #参数可能含有密码等敏感数据,只用于 explain,不保存
+    entry = dict(sql=sql,fingerprint=key,ms=round(ms,3),rows=rows,at=time.time(),explain=None)
+    _slow_queries.append(entry)
+    if _explains is None or sql.lstrip()[:6].lower() != 'select':
+        return
+    plan = _explains.get(key,None)
+    if plan is not None:
+        entry['explain'] = plan
+        return
+    #先放入空的执行计划,避免同一类语句并发触发多次 explain; explain 完成后原地填充,共用它的记录都能看到
+    plan = entry['explain'] = []
+    _explains.set(key,plan)
+    task = asyncio.ensure_future(_explain(plan,sql,args))
+    _explain_tasks.add(task)
+    task.add_done_callback(_explain_tasks.discard)
+
+#在主库上另取一个连接执行 explain,结果以 dict 列表填入 plan
+async def _explain(plan,sql,args):
+    try:
+        async with _acquire(_writer_pool()) as connection:
+            cursor = await connection.cursor(_backend.driver.DictCursor)
+            await cursor.execute('%s %s'%(_backend.explain,compile_sql(sql)),args)
+            plan.extend(dict(r) for r in await cursor.fetchall())
+            await cursor.close()
+    except Exception as e:
+        logging.warning('failed to explain slow query: %s'%e)
+        plan.append(dict(error=str(e)))
+
+#最近的慢查询,最新的在前
+def slow_queries():
+    return dict(threshold=_slow_ms,queries=list(reversed(_slow_queries)))
+
+#从连接池获取连接,并记录等待时间
+@contextlib.asynccontextmanager
+async def _acquire(pool):
+    stats = _pool_stats.get(pool,None)
+    limiter = stats.limiter if stats is not None else None
+    start = time.perf_counter()
+    if stats is not None:
+        stats.waiting += 1
+    try:
+        if limiter is not None:
+            if limiter.active >= limiter.limit and stats.manager is not None:
+                stats.manager.grow()
+            await limiter.acquire()
+        try:
+            connection = await pool.acquire()
+        except BaseException:
+            if limiter is not None:
+                limiter.release()
+            raise
+    finally:
+        if stats is not None:
+            stats.waiting -= 1
+    if stats is not None:
+        stats.record_wait((time.perf_counter() - start) * 1000)
+    try:
+        yield connection
+    finally:
+        try:
+            await pool.release(connection)
+        finally:
+            if limiter is not None:
+                limiter.release()
+
+#连接池与语句执行的统计
+def pool_stats():
+    return [s.stats() for s in _pool_stats.values()]
+
+def query_stats():
+    res = [dict(sql=k,**h.stats()) for k,h in _query_stats.items()]
+    res.sort(key=lambda r: r['total'],reverse=True)
+    return res
+
+#*********************************** Pool Sizing **********************************#*******
+
+#可调整上限的并发限制: 同时持有连接的协程数不超过 limit
+class Limiter(object):
+    def __init__(self,limit):
+        self.limit = limit
+        self.active = 0
+        self._waiters = collections.deque()
+
+    async def acquire(self):
+        while self.active >= self.limit:
+            waiter = asyncio.get_event_loop().create_future()
+            self._waiters.append(waiter)
+            try:
+                await waiter
+            except BaseException:
+                #已被唤醒却被取消时,把机会让给下一个等待者
+                if waiter.done() and not waiter.cancelled():
+                    self._wakeup()
+                raise
+            finally:
+                if waiter in self._waiters:
+                    self._waiters.remove(waiter)
+        self.active += 1
+
+    def release(self):
+        self.active -= 1
+        self._wakeup()
+
+    def resize(self,limit):
+        self.limit = limit
+        for i in range(limit - self.active):
+            self._wakeup()
+
+    def _wakeup(self):
+        while self._waiters:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                return
+
+#连接池维护: 启动时预先建立 prewarm 个连接; 每 ping 秒检查一遍空闲连接,失效的连接重连或关闭;
+#每 adjust 秒根据获取连接的平均等待时间在 [minsize,maxsize] 之间调整可同时使用的连接数,并关闭多余的空闲连接;
+#连接数已到上限时有请求需要排队,立即扩大上限,不等下一个周期
+class PoolManager(object):
+    def __init__(self,stats,minsize=1,maxsize=10,prewarm=0,ping=30,adjust=5,grow_wait=5):
+        self.pool_stats = stats
+        self.pool = stats.pool
+        self.minsize = minsize
+        self.maxsize = maxsize
+        self.prewarm = min(prewarm,maxsize)
+        self.ping_interval = ping
+        self.adjust_interval = adjust
+        #平均等待超过该毫秒数时扩大上限
+        self.grow_wait = grow_wait
+        self.pings = 0
+        self.stale = 0
+        self.grown = 0
+        self.shrunk = 0
+        self._task = None
+        #从 maxsize 开始,部署后的第一波请求不排队; 空闲时再逐步缩小
+        stats.limiter = Limiter(maxsize)
+        stats.manager = self
+
+    #同时取出 prewarm 个连接再放回,让连接在第一批请求到来前建立好
+    async def warm(self):
+        if not self.prewarm:
+            return
+        connections = await asyncio.gather(*[self.pool.acquire() for i in range(self.prewarm)],return_exceptions=True)
+        errors = [c for c in connections if isinstance(c,BaseException)]
+        for c in connections:
+            if not isinstance(c,BaseException):
+                await self.pool.release(c)
+        if errors:
+            logging.warning('failed to prewarm %s connections for %s: %s'%(len(errors),self.pool_stats.name,errors[0]))
+        logging.info('prewarmed %s connections for %s'%(self.prewarm - len(errors),self.pool_stats.name))
+
+    def start(self):
+        self._task = asyncio.ensure_future(self._run())
+
+    def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    async def _run(self):
+        last_ping = time.time()
+        while True:
+            await asyncio.sleep(self.adjust_interval)
+            try:
+                self.adjust()
+                await self.trim()
+                if self.ping_interval and time.time() - last_ping >= self.ping_interval:
+                    last_ping = time.time()
+                    await self.ping_idle()
+            except Exception as e:
+                logging.warning('failed to maintain pool %s: %s'%(self.pool_stats.name,e))
+
+    #上一周期有请求在排队且平均等待超过 grow_wait 毫秒时,上限扩大约1/4;
+    #整个周期使用的连接数峰值不到上限的一半时,上限减1
+    def adjust(self):
+        count,total,peak = self.pool_stats.take_window()
+        limiter = self.pool_stats.limiter
+        if count and total / count > self.grow_wait and limiter.limit < self.maxsize:
+            limit = min(self.maxsize,limiter.limit + max(1,limiter.limit // 4))
+            self.grown += 1
+        elif peak * 2 < limiter.limit and limiter.limit > self.minsize:
+            limit = limiter.limit - 1
+            self.shrunk += 1
+        else:
+            return
+        logging.info('resize pool %s: %s -> %s (avg wait %.1fms, peak %s)'%(self.pool_stats.name,limiter.limit,limit,total / count if count else 0,peak))
+        limiter.resize(limit)
+
+    #上限已用满时立即加 1
+    def grow(self):
+        limiter = self.pool_stats.limiter
+        if limiter.limit < self.maxsize:
+            self.grown += 1
+            limiter.resize(limiter.limit + 1)
+
+    #关闭超出上限的空闲连接
+    async def trim(self):
+        while self.pool.size > max(self.pool_stats.limiter.limit,self.minsize) and self.pool.freesize:
+            connection = await self.pool.acquire()
+            connection.close()
+            await self.pool.release(connection)
+
+    #依次取出每个空闲连接 ping 一次(aiomysql 会尝试重连),仍然失败的关闭
+    async def ping_idle(self):
+        for i in range(self.pool.freesize):
+            if not self.pool.freesize:
+                break
+            connection = await self.pool.acquire()
+            try:
+                await connection.ping()
+                self.pings += 1
+            except Exception as e:
+                logging.warning('close stale connection in %s: %s'%(self.pool_stats.name,e))
+                self.stale += 1
+                connection.close()
+            finally:
+                await self.pool.release(connection)
+
+    def stats(self):
+        return dict(minsize=self.minsize,pings=self.pings,stale=self.stale,grown=self.grown,shrunk=self.shrunk)
+
+#*********************************** Backend **************************************#*******
+
+#数据库后端: 负责打开连接池,并给出驱动的游标类、占位符和方言上的差异
+#游标类、连接和连接池的用法与 aiomysql 相同
+class MySQLBackend(object):
+    name = 'mysql'
+    driver = aiomysql
+    placeholder = '%s'
+    explain = 'explain'
+    #连接层面的错误,出现时可以换一个连接重试只读查询
+    errors = (aiomysql.OperationalError,aiomysql.InterfaceError,OSError)
+    #upsert 的影响行数能否区分插入(1)与更新(2)
+    upsert_rowcount = True
+    #连接按需建立,需要预热、ping 和动态调整
+    managed = True
+
+    def __init__(self):
+        #(host,port) -> 连接配置,中止查询时据此另开连接
+        self._conf = dict()
+        self._kills = set()
+
+    #返回 (写连接池,名称,[(只读连接池,名称)],副本延迟窗口秒数)
+    async def open(self,loop,readers,sticky,kw):
+        writer = await _open_pool(loop,**kw)
+        self._conf[(kw.get('host','127.0.0.1'),kw.get('port',3306))] = kw
+        pools = []
+        for reader in readers:
+            conf = dict(kw)
+            conf.update(reader)
+            logging.info('Creating read replica pool %s:%s...'%(conf.get('host','127.0.0.1'),conf.get('port',3306)))
+            pools.append((await _open_pool(loop,**conf),'reader %s:%s'%(conf.get('host','127.0.0.1'),conf.get('port',3306))))
+            self._conf[(conf.get('host','127.0.0.1'),conf.get('port',3306))] = conf
+        return writer,'writer %s:%s'%(kw.get('host','127.0.0.1'),kw.get('port',3306)),pools,sticky
+
+    #中止连接上正在执行的查询: 关闭该连接(放回连接池时被丢弃),再另开一个连接执行 kill query
+    def abort(self,connection):
+        thread_id = connection.thread_id()
+        conf = self._conf.get((connection.host,connection.port),None)
+        connection.close()
+        if conf is not None:
+            task = asyncio.ensure_future(self._kill(conf,thread_id))
+            self._kills.add(task)
+            task.add_done_callback(self._kills.discard)
+
+    async def _kill(self,conf,thread_id):
+        try:
+            connection = await aiomysql.connect(host=conf.get('host','127.0.0.1'),port=conf.get('port',3306),user=conf['user'],password=conf['password'],db=conf['db'],charset=conf.get('charset','utf8'))
+            try:
+                async with connection.cursor() as cursor:
+                    await cursor.execute('kill query %s',(thread_id,))
+            finally:
+                connection.close()
+        except Exception as e:
+            logging.warning('failed to kill query on connection %s: %s'%(thread_id,e))
+
+    def upsert(self,insert,primary_key,fields):
+        return '%s on duplicate key update %s'%(insert,','.join('%s=values(%s)'%(k,k) for k in fields))
+
+    #数据库中已有的表
+    async def tables(self):
+        rows = await _select_on(_writer_pool(),'select table_name as name from information_schema.tables where table_schema=database()',(),None,False)
+        return set(r['name'] for r in rows)
+
+    #表上已有的索引(不含主键),索引名 -> (是否唯一,列)
+    async def indexes(self,table):
+        rows = await _select_on(_writer_pool(),"select index_name as name,non_unique as non_unique,column_name as col from information_schema.statistics where table_schema=database() and table_name=? and index_name<>'PRIMARY' order by index_name,seq_in_index",[table],None,False)
+        res = dict()
+        for r in rows:
+            unique,columns = res.get(r['name'],(not r['non_unique'],()))
+            res[r['name']] = (unique,columns + (r['col'],))
+        return res
+
+    #table 指定时按模型的字段建立另一张表(如转换主键类型时的新表)
+    def create_table(self,model,table=None):
+        return 'create table %s(\n    %s,\n    primary key(%s)\n) engine=innodb default charset=utf8'%(table or model.__table__,',\n    '.join('%s %s not null'%(k,model.__mappings__[k].column) for k in model.__columns__),model.__primary_key__)
+
+    def create_index(self,table,index):
+        return 'alter table %s add %sindex %s(%s)'%(table,'unique ' if index.unique else '',index.name,','.join(index.columns))
+
+    def rename_table(self,table,name):
+        return 'rename table %s to %s'%(table,name)
+
+#嵌入式 SQLite 后端(单机部署和性能测试用): db 为数据库文件路径, WAL 模式下一个写连接加 maxsize 个只读连接,
+#select 使用只读连接; 同一进程内提交后立即可读,不需要 sticky。给出 schema 时启动时按 schema.sql 建表
+class SQLiteBackend(object):
+    name = 'sqlite'
+    driver = orm_sqlite
+    placeholder = '?'
+    explain = 'explain query plan'
+    #本地文件没有连接故障,出错时不切换连接池
+    errors = ()
+    upsert_rowcount = False
+    #连接在启动时全部打开,不需要维护
+    managed = False
+
+    async def open(self,loop,readers,sticky,kw):
+        path = kw['db']
+        if kw.get('schema',None):
+            orm_sqlite.init_schema(path,kw['schema'])
+        writer = await orm_sqlite.create_pool(path,maxsize=1)
+        logging.info('Creating sqlite reader pool %s...'%path)
+        reader = await orm_sqlite.create_pool(path,maxsize=kw.get('maxsize',4),readonly=True)
+        return writer,'writer %s'%path,[(reader,'reader %s'%path)],0
+
+    def upsert(self,insert,primary_key,fields):
+        return orm_sqlite.upsert(insert,primary_key,fields)
+
+    #中断正在执行的语句,连接仍可继续使用
+    def abort(self,connection):
+        connection.interrupt()
+
+    async def tables(self):
+        rows = await _select_on(_writer_pool(),"select name from sqlite_master where type='table'",(),None,False)
+        return set(r['name'] for r in rows)
+
+    async def indexes(self,table):
+        res = dict()
+        for r in await _select_on(_writer_pool(),'select name,"unique" as uniq,origin from pragma_index_list(?)',[table],None,False):
+            #主键约束自动建立的索引
+            if r['origin'] == 'pk':
+                continue
+            columns = await _select_on(_writer_pool(),'select name from pragma_index_info(?) order by seqno',[r['name']],None,False)
+            res[r['name']] = (bool(r['uniq']),tuple(c['name'] for c in columns))
+        return res
+
+    def create_table(self,model,table=None):
+        return 'create table %s(\n    %s,\n    primary key(%s)\n)'%(table or model.__table__,',\n    '.join('%s %s not null'%(k,model.__mappings__[k].column) for k in model.__columns__),model.__primary_key__)
+
+    def create_index(self,table,index):
+        return 'create %sindex %s on %s(%s)'%('unique ' if index.unique else '',index.name,table,','.join(index.columns))
+
+    def rename_table(self,table,name):
+        return 'alter table %s rename to %s'%(table,name)
+
+_backends = dict(mysql=MySQLBackend(),sqlite=SQLiteBackend())
+_backend = _backends['mysql']
+
 #*********************************** SQL Operation ********************************#*******
 
-#创建数据库连接池
-async def create_pool(loop,**kw):  
+#创建数据库连接池, backend 为 'mysql' 或 'sqlite'
+#readers 为只读副本列表(如 [dict(host='10.0.0.2')],未给出的参数沿用主库配置),select 在健康的副本间轮询,
+#update,insert,delete 只发往主库; sticky 秒内写过数据的会话,其读请求也发往主库以读到自己的写入
+#results 为查询结果缓存的配置,如 dict(size=2000,ttl=60,maxrows=1000)
+#slow 为慢查询日志的配置,如 dict(threshold=200,size=100,explain=True)
+#连接池在 minsize 和 maxsize 之间按等待时间调整,启动时预先建立 prewarm 个连接,每 ping 秒检查空闲连接
+async def create_pool(loop,backend='mysql',readers=(),sticky=5,results=None,slow=None,**kw):  
     logging.info('Creating database connection pool...')
-    global __pool
-    __pool = await aiomysql.create_pool(
+    global __pool,__readers,__last_write,__sticky,_backend
+    if results:
+        configure_result_cache(**results)
+    configure_slow_log(**(slow or {}))
+    _backend = _backends[backend]
+    __pool,name,pools,sticky = await _backend.open(loop,readers,sticky,kw)
+    _pool_stats.clear()
+    _pool_stats[__pool] = PoolStats(name,__pool)
+    __readers = []
+    for pool,name in pools:
+        _pool_stats[pool] = PoolStats(name,pool)
+        __readers.append(Replica(pool))
+    if _backend.managed:
+        for stats in _pool_stats.values():
+            manager = PoolManager(stats,minsize=kw.get('minsize',1),maxsize=kw.get('maxsize',10),prewarm=kw.get('prewarm',0),ping=kw.get('ping',30),adjust=kw.get('adjust',5),grow_wait=kw.get('grow_wait',5))
+            await manager.warm()
+            manager.start()
+    __last_write = LRUCache(maxsize=10000,ttl=sticky) if sticky else None
+    __sticky = sticky
+
+async def _open_pool(loop,**kw):
+    return await aiomysql.create_pool(
         host = kw.get('host','127.0.0.1'),         
         port = kw.get('port',3306),
         maxsize = kw.get('maxsize',10),             #最大连接数
@@ -25,37 +597,245 @@ async def create_pool(loop,**kw):
         loop = loop
     )
 
+#只读副本,出现连接错误后在 retry 秒内不再使用
+class Replica(object):
+    def __init__(self,pool,retry=30):
+        self.pool = pool
+        self.retry = retry
+        self.down_until = 0
+
+    @property
+    def healthy(self):
+        return self.down_until < time.time()
+
+    def mark_down(self):
+        self.down_until = time.time() + self.retry
+
+#当前请求所属的会话(如用户 id),用于读写一致
+_session = contextvars.ContextVar('session',default=None)
+__readers = []
+__last_write = None
+__sticky = 0
+__next_reader = 0
+
+#主库连接池
+def _writer_pool():
+    return __pool
+
+#关闭所有连接池
+async def close_pool():
+    await flush_writers()
+    logging.info('Closing database connection pool...')
+    for stats in _pool_stats.values():
+        if stats.manager is not None:
+            stats.manager.stop()
+    for pool in [__pool] + [r.pool for r in __readers]:
+        pool.close()
+        await pool.wait_closed()
+
+#副本可能落后主库的时间窗口,没有副本时为0
+def replica_window():
+    return __sticky if __readers else 0
+
+#绑定当前请求的会话
+def bind_session(key):
+    return _session.set(key)
+
+#记录当前会话刚刚写过数据
+def _mark_write():
+    key = _session.get()
+    if key is not None and __last_write is not None:
+        __last_write.set(key,True)
+
+#当前会话刚写过数据,读请求需要发往主库
+def _sticky():
+    key = _session.get()
+    return key is not None and __last_write is not None and __readers and bool(__last_write.get(key))
+
+#为只读查询挑选连接池: 会话刚写过数据或没有健康的副本时使用主库
+def _read_pool():
+    global __next_reader
+    if not __readers or _sticky():
+        return None
+    n = len(__readers)
+    for i in range(n):
+        replica = __readers[(__next_reader + i) % n]
+        if replica.healthy:
+            __next_reader = (__next_reader + i + 1) % n
+            return replica
+    return None
+
 # select 子句
-async def select(sql,args=(),size=None):
+# 相同的语句和参数正在执行时,等待并共用其结果; 每次都必须真正执行的查询传入 coalesce=False
+# cache=True 时使用查询结果缓存,所读的表被写入后缓存自动失效
+async def select(sql,args=(),size=None,coalesce=True,cache=False):
     logging.info('SQL:%s\nARGS:%s'%(sql,args))
+    if cache:
+        return await _select_cached(sql,args,size,False,coalesce)
+    if coalesce:
+        return await _select_shared(sql,args,size,False)
+    return await _select(sql,args,size,False)
+
+# select 子句,以元组形式返回结果,返回 (列名,行) 
+async def select_rows(sql,args=(),size=None,coalesce=True,cache=False):
+    logging.info('SQL:%s\nARGS:%s'%(sql,args))
+    if cache:
+        return await _select_cached(sql,args,size,True,coalesce)
+    if coalesce:
+        return await _select_shared(sql,args,size,True)
+    return await _select(sql,args,size,True)
+
+#正在执行的查询: (sql,参数,size,raw,所读各表的版本) -> task
+_inflight = dict()
+_coalesce_stats = dict(executed=0,shared=0)
+
+#合并相同的并发查询,只有第一个调用方真正执行,其余调用方等待同一个结果
+#键中包含所读各表的版本: 调用方自己(或其他请求)写入这些表之后,不会再等待写入之前开始的查询
+async def _select_shared(sql,args,size,raw):
+    #事务中、需要读主库或无法识别所读的表时不合并
+    tables = read_tables(sql)
+    if not tables or _transaction.get() is not None or _sticky():
+        return await _select(sql,args,size,raw)
+    try:
+        key = (sql,tuple(args) if args else (),size,raw,_read_versions(tables))
+        task = _inflight.get(key,None)
+    except TypeError:
+        return await _select(sql,args,size,raw)
+    if task is not None:
+        _coalesce_stats['shared'] += 1
+        res = await _wait_shared(task)
+        #dict 行各自复制一份,避免调用方互相影响
+        return res if raw else [dict(r) for r in res]
+    _coalesce_stats['executed'] += 1
+    #单独的 task 执行查询,第一个调用方被取消时不影响其他等待者;
+    #task 本身不设截止时间,每个调用方在 _wait_shared 中按自己的截止时间等待
+    context = contextvars.copy_context()
+    context.run(_deadline.set,None)
+    task = context.run(asyncio.ensure_future,_select(sql,args,size,raw))
+    task.waiters = 0
+    _inflight[key] = task
+    task.add_done_callback(functools.partial(_select_done,key))
+    return await _wait_shared(task)
+
+#等待合并的查询; 所有调用方都被取消或超时时(如客户端都已断开)取消查询,由 _guard 中止服务端的执行
+async def _wait_shared(task):
+    task.waiters += 1
+    try:
+        return await _wait_deadline(asyncio.shield(task),'coalesced select')
+    except (asyncio.CancelledError,DeadlineExceeded):
+        if task.waiters == 1:
+            task.cancel()
+        raise
+    finally:
+        task.waiters -= 1
+
+def _select_done(key,task):
+    if _inflight.get(key,None) is task:
+        del _inflight[key]
+    #所有调用方都已取消时,取走异常避免未处理异常的警告
+    if not task.cancelled():
+        task.exception()
+
+#查询合并统计
+def coalesce_stats():
+    return dict(inflight=len(_inflight),**_coalesce_stats)
+
+async def _select(sql,args,size,raw):
     global __pool
-    async with __pool.get() as connection:
-        #从连接池获取连接
-        cursor =await connection.cursor(aiomysql.DictCursor)
-        #执行sql语句(语句与参数分离)
-        await cursor.execute(sql.replace('?','%s'),args)
-        #根据size(即记录的行数)返回查询结果
-        if not size:
-            res = await cursor.fetchall()
-        else:
-            res = await cursor.fetchmany(size)
-        await cursor.close()
+    #事务中使用事务固定的连接
+    tx = _transaction.get()
+    if tx is not None:
+        return await _query(tx.connection,sql,args,size,raw)
+    replica = _read_pool()
+    if replica is not None:
+        try:
+            return await _select_on(replica.pool,sql,args,size,raw)
+        except _backend.errors as e:
+            logging.warning('read replica failed, fall back to writer: %s'%e)
+            replica.mark_down()
+    return await _select_on(__pool,sql,args,size,raw)
+
+async def _select_on(pool,sql,args,size,raw):
+    #从连接池获取连接
+    async with _acquire(pool) as connection:
+        return await _query(connection,sql,args,size,raw)
+
+async def _query(connection,sql,args,size,raw=False):
+    cursor =await connection.cursor(_backend.driver.Cursor if raw else _backend.driver.DictCursor)
+    start = time.perf_counter()
+    res = await _guard(connection,sql,_fetch(cursor,sql,args,size))
+    _record_query(sql,(time.perf_counter() - start) * 1000,len(res),args)
+    columns = tuple(d[0] for d in cursor.description or ())
+    await cursor.close()
     logging.info('return rows:%s'%len(res))
+    if raw:
+        return columns,res
     return res
 
+async def _fetch(cursor,sql,args,size):
+    #执行sql语句(语句与参数分离)
+    await cursor.execute(compile_sql(sql),args)
+    #根据size(即记录的行数)返回查询结果
+    if not size:
+        return await cursor.fetchall()
+    return await cursor.fetchmany(size)
+
+# 流式 select 子句: 使用无缓冲的服务端游标逐批读取,遍历期间占用同一个连接
+# 在事务中使用时,遍历结束前不能在该事务中执行其他语句; raw 为 True 时以元组形式返回每行
+async def select_iter(sql,args=(),batch=100,raw=False):
+    logging.info('SQL:%s\nARGS:%s'%(sql,args))
+    global __pool
+    tx = _transaction.get()
+    if tx is not None:
+        async for res in _query_iter(tx.connection,sql,args,batch,raw):
+            yield res
+        return
+    replica = _read_pool()
+    pool = replica.pool if replica is not None else __pool
+    async with _acquire(pool) as connection:
+        async for res in _query_iter(connection,sql,args,batch,raw):
+            yield res
+
+async def _query_iter(connection,sql,args,batch,raw):
+    cursor = await connection.cursor(_backend.driver.SSCursor if raw else _backend.driver.SSDictCursor)
+    try:
+        start = time.perf_counter()
+        await _guard(connection,sql,cursor.execute(compile_sql(sql),args))
+        _record_query(sql,(time.perf_counter() - start) * 1000,0,args)
+        while True:
+            res = await _guard(connection,sql,cursor.fetchmany(batch))
+            if not res:
+                break
+            yield res
+    finally:
+        #提前结束遍历时,close会读完剩余结果,连接才能放回连接池; 已中止的连接不再读取
+        if not getattr(connection,'closed',False):
+            await cursor.close()
+
 # update,insert,delete 子句
 async def execute(sql,args,autocommit=True):
     logging.info('SQL:%s\nARGS:%s'%(sql,args))
     global __pool
-    async with __pool.get() as connection:
+    _mark_write()
+    tx = _transaction.get()
+    if tx is not None:
+        try:
+            return await _execute(tx.connection,sql,args)
+        finally:
+            #提交前其他连接仍可能读到并缓存旧数据,提交后再失效一次
+            _table_written(sql)
+            after_commit(_table_written,sql)
+    try:
+        return await _execute_on(__pool,sql,args,autocommit)
+    finally:
+        _table_written(sql)
+
+async def _execute_on(pool,sql,args,autocommit):
+    async with _acquire(pool) as connection:
         if not autocommit:
             await connection.begin()
         try:
-            cursor = await connection.cursor(aiomysql.DictCursor)
-            await cursor.execute(sql.replace('?','%s'),args)
-            rowcount = cursor.rowcount
-            await cursor.close()
-            logging.info('Affected rowcount:%s'%rowcount)
+            rowcount = await _execute(connection,sql,args)
             if not autocommit:
                 await connection.commit()
         except:
@@ -64,45 +844,777 @@ async def execute(sql,args,autocommit=True):
             raise
     return rowcount
 
+async def _execute(connection,sql,args):
+    cursor = await connection.cursor(_backend.driver.DictCursor)
+    start = time.perf_counter()
+    await _guard(connection,sql,cursor.execute(compile_sql(sql),args))
+    _record_query(sql,(time.perf_counter() - start) * 1000,0,args)
+    rowcount = cursor.rowcount
+    await cursor.close()
+    logging.info('Affected rowcount:%s'%rowcount)
+    return rowcount
+
+# 在同一事务中依次执行多条 update,insert,delete 子句,返回每条语句的影响行数
+async def execute_batch(statements):
+    rowcounts = []
+    async with transaction():
+        for sql,args in statements:
+            rowcounts.append(await execute(sql,args))
+    logging.info('Affected rowcounts:%s'%rowcounts)
+    return rowcounts
+
+#*********************************** Deadline *************************************#*******
+
+#当前请求的截止时间(time.monotonic()),None 表示不限制
+_deadline = contextvars.ContextVar('deadline',default=None)
+_deadline_stats = dict(exceeded=0,aborted=0)
+
+#超过截止时间时 select/execute 抛出的异常
+class DeadlineExceeded(asyncio.TimeoutError):
+    pass
+
+#设置当前请求的截止时间: seconds 秒后 select/execute 不再等待数据库; 返回的 token 交给 reset_deadline
+def set_deadline(seconds):
+    return _deadline.set(time.monotonic() + seconds)
+
+def reset_deadline(token):
+    _deadline.reset(token)
+
+#距离截止时间的剩余秒数,没有截止时间时返回 None
+def remaining():
+    deadline = _deadline.get()
+    return deadline - time.monotonic() if deadline is not None else None
+
+#在截止时间内等待数据库操作; 超时或被取消(如客户端断开)时中止服务端的查询,连接立即交还连接池
+async def _guard(connection,sql,aw):
+    timeout = remaining()
+    if timeout is not None and timeout <= 0:
+        aw.close()
+        _deadline_stats['exceeded'] += 1
+        raise DeadlineExceeded('deadline exceeded before query: %s'%sql)
+    try:
+        if timeout is None:
+            return await aw
+        return await asyncio.wait_for(aw,timeout)
+    except asyncio.TimeoutError:
+        _deadline_stats['exceeded'] += 1
+        _abort(connection,sql)
+        raise DeadlineExceeded('deadline exceeded during query: %s'%sql)
+    except asyncio.CancelledError:
+        _abort(connection,sql)
+        raise
+
+#在当前的截止时间内等待不由本任务执行的操作(如合并的查询、批量加载),超时时抛出 DeadlineExceeded
+async def _wait_deadline(aw,what):
+    timeout = remaining()
+    if timeout is None:
+        return await aw
+    if timeout <= 0:
+        _deadline_stats['exceeded'] += 1
+        aw.cancel()
+        raise DeadlineExceeded('deadline exceeded before %s'%what)
+    try:
+        return await asyncio.wait_for(aw,timeout)
+    except DeadlineExceeded:
+        raise
+    except asyncio.TimeoutError:
+        _deadline_stats['exceeded'] += 1
+        raise DeadlineExceeded('deadline exceeded waiting for %s'%what)
+
+def _abort(connection,sql):
+    _deadline_stats['aborted'] += 1
+    logging.warning('abort query: %s'%sql)
+    try:
+        _backend.abort(connection)
+    except Exception as e:
+        logging.warning('failed to abort query: %s'%e)
+
+#截止时间统计: 超时次数与中止的查询数
+def deadline_stats():
+    return dict(_deadline_stats)
+
+#*********************************** Transaction **********************************#*******
+
+#当前任务所在的事务
+_transaction = contextvars.ContextVar('transaction',default=None)
+
+#事务: 固定使用一个连接,并保存提交后要执行的回调
+class Transaction(object):
+    def __init__(self,connection):
+        self.connection = connection
+        self.callbacks = []
+
+#多语句事务,用法: async with orm.transaction(): ...
+#块内的 select/execute 以及模型的 find/save/update/remove 都使用同一个连接,
+#正常结束时提交,抛出异常时回滚; 嵌套使用时并入最外层的事务
+@contextlib.asynccontextmanager
+async def transaction():
+    tx = _transaction.get()
+    if tx is not None:
+        yield tx
+        return
+    global __pool
+    _mark_write()
+    async with _acquire(__pool) as connection:
+        await connection.begin()
+        tx = Transaction(connection)
+        token = _transaction.set(tx)
+        try:
+            yield tx
+        except BaseException:
+            #查询被中止时连接已关闭,服务端会自动回滚
+            try:
+                await connection.rollback()
+            except Exception as e:
+                logging.warning('failed to rollback transaction: %s'%e)
+            raise
+        else:
+            await connection.commit()
+        finally:
+            _transaction.reset(token)
+    for fn,args in tx.callbacks:
+        fn(*args)
+
+#事务提交后再调用 fn,不在事务中时立即调用
+def after_commit(fn,*args):
+    tx = _transaction.get()
+    if tx is None:
+        fn(*args)
+    else:
+        tx.callbacks.append((fn,args))
+
+#*********************************** Row Counter **********************************#*******
+
+#行数计数器: 缓存每张表(以及按某列取值过滤后)的记录数,save/remove 时增量维护,
+#定期与数据库核对以纠正多进程写入等原因造成的偏差
+class RowCounter(object):
+    def __init__(self,maxsize=10000):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        #(表名,列名,列值) -> 记录数,列名为 None 表示整张表
+        self._counts = collections.OrderedDict()
+
+    def get(self,key):
+        num = self._counts.get(key,None)
+        if num is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+            self._counts.move_to_end(key)
+        return num
+
+    def set(self,key,num):
+        self._counts[key] = num
+        self._counts.move_to_end(key)
+        if len(self._counts) > self.maxsize:
+            self._counts.popitem(last=False)
+
+    #只调整已缓存的计数,未缓存的等到下次读取时再查询
+    def add(self,key,delta):
+        if key in self._counts:
+            self._counts[key] += delta
+
+    def keys(self):
+        return list(self._counts.keys())
+
+    #丢弃某张表的全部计数
+    def forget(self,table):
+        for key in [k for k in self._counts if k[0] == table]:
+            del self._counts[key]
+
+    def stats(self):
+        return dict(size=len(self._counts),maxsize=self.maxsize,hits=self.hits,misses=self.misses)
+
+_counter = RowCounter()
+
+#所有模型, 表名 -> 模型类
+_models = dict()
+
+#重新查询所有已缓存的计数
+async def reconcile_counters():
+    for key in _counter.keys():
+        table,column,value = key
+        model = _models.get(table,None)
+        if model is None:
+            continue
+        num = await model._count(column,value)
+        old = _counter._counts.get(key,None)
+        if old is not None and old != num:
+            logging.warning('counter drift on %s: cached %s, actual %s'%(key,old,num))
+        _counter.set(key,num)
+
+#启动定期核对计数器的后台任务
+def start_counter_reconciler(loop,interval=300):
+    async def reconcile_forever():
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await reconcile_counters()
+            except Exception as e:
+                logging.exception(e)
+    return loop.create_task(reconcile_forever())
+
+#计数器统计
+def counter_stats():
+    return _counter.stats()
+
+#*********************************** Row Cache ************************************#*******
+
+#有容量上限和过期时间(秒)的 LRU 缓存
+class LRUCache(object):
+    def __init__(self,maxsize=1000,ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        #每次失效加一,用于丢弃失效前发起的查询结果
+        self.generation = 0
+        #最近一次失效的时间
+        self.invalidated_at = 0
+        #key -> (过期时间,value)
+        self._data = collections.OrderedDict()
+
+    def get(self,key,default=None):
+        item = self._data.get(key,None)
+        if item is None:
+            self.misses += 1
+            return default
+        expires,value = item
+        if expires is not None and expires < time.time():
+            del self._data[key]
+            self.expirations += 1
+            self.misses += 1
+            return default
+        self._data.move_to_end(key)
+        self.hits += 1
+        return value
+
+    #ttl 为 None 时使用缓存默认的过期时间
+    def set(self,key,value,ttl=None):
+        ttl = self.ttl if ttl is None else ttl
+        self._data[key] = (time.time() + ttl if ttl is not None else None,value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+            self.evictions += 1
+
+    def pop(self,key):
+        self.generation += 1
+        self.invalidated_at = time.time()
+        item = self._data.pop(key,None)
+        return item[1] if item is not None else None
+
+    def clear(self):
+        self.generation += 1
+        self.invalidated_at = time.time()
+        self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+    def stats(self):
+        return dict(size=len(self._data),maxsize=self.maxsize,ttl=self.ttl,hits=self.hits,misses=self.misses,evictions=self.evictions,expirations=self.expirations)
+
+#请求范围的 identity map: (表名,主键) -> 模型实例,同一请求内多次 find 共享同一个对象
+_identity = contextvars.ContextVar('identity_map',default=None)
+
+#开启 identity map,返回的 token 交给 end_identity_map
+def begin_identity_map():
+    return _identity.set(dict())
+
+def end_identity_map(token):
+    _identity.reset(token)
+
+#各模型主键缓存的统计
+def cache_stats():
+    return dict((table,model.__rowcache__.stats()) for table,model in _models.items() if model.__rowcache__ is not None)
+
+#*********************************** Result Cache *********************************#*******
+
+#查询结果缓存: (语句,参数,所读各表的版本) -> 结果; 写入某张表时该表版本加一,
+#缓存的旧结果不会再被命中,随 LRU 淘汰或过期; 只在本进程内失效,ttl 限定其他进程写入后的最长陈旧时间
+_results = LRUCache(maxsize=2000,ttl=60)
+#结果行数超过 maxrows 时不缓存
+_results_maxrows = 1000
+#表名 -> 版本
+_table_versions = dict()
+#表名 -> 最近一次写入的时间
+_table_write_at = dict()
+_result_stats = dict(uncacheable=0,skipped=0)
+
+#设置查询结果缓存的容量、过期时间(秒)和可缓存的最大行数
+def configure_result_cache(size=2000,ttl=60,maxrows=1000):
+    global _results,_results_maxrows
+    _results = LRUCache(maxsize=size,ttl=ttl)
+    _results_maxrows = maxrows
+
+_RE_READ_TABLES = re.compile(r'\b(?:from|join)\s+`?(\w+)`?((?:\s*,\s*`?\w+`?)*)',re.I)
+_RE_WRITE_TABLE = re.compile(r'^\s*(?:insert\s+(?:ignore\s+)?into|replace\s+into|update|delete\s+from)\s+`?(\w+)`?',re.I)
+
+def _read_tables(sql):
+    tables = set()
+    for first,rest in _RE_READ_TABLES.findall(sql):
+        tables.add(first.lower())
+        tables.update(t.strip(' `').lower() for t in rest.split(',') if t.strip(' `'))
+    return tuple(sorted(tables))
+
+#sql -> 读取/写入的表,与语句缓存分开,避免每次执行都计入语句缓存的命中并挤掉缓存的语句
+_read_table_names = StatementCache(maxsize=2048)
+_write_table_names = StatementCache(maxsize=2048)
+
+#语句读取的表,无法识别时返回空元组(不缓存)
+def read_tables(sql):
+    return _read_table_names.get(sql,_read_tables,sql)
+
+#所读各表的当前版本; 无法识别所写的表的写入记在 None 下,使所有表的版本都变化
+def _read_versions(tables):
+    return (_table_versions.get(None,0),) + tuple(_table_versions.get(t,0) for t in tables)
+
+def _write_table(sql):
+    m = _RE_WRITE_TABLE.match(sql)
+    return m.group(1).lower() if m is not None else None
+
+#记录语句写入的表,使其缓存结果失效; 无法识别写入的表时清空全部缓存
+def _table_written(sql):
+    table = _write_table_names.get(sql,_write_table,sql)
+    if table is None:
+        _results.clear()
+        _table_versions[None] = _table_versions.get(None,0) + 1
+        return
+    _table_versions[table] = _table_versions.get(table,0) + 1
+    _table_write_at[table] = time.time()
+
+#使用结果缓存的查询; 事务中或需要读主库时不使用缓存
+async def _select_cached(sql,args,size,raw,coalesce):
+    query = _select_shared if coalesce else _select
+    tables = read_tables(sql)
+    if not tables or _transaction.get() is not None or _sticky():
+        _result_stats['uncacheable'] += 1
+        return await query(sql,args,size,raw)
+    try:
+        #查询开始前的版本: 执行期间发生的写入会使本次结果随即失效;
+        #_select_shared 按同样的版本合并,只会等待在这些版本下开始的查询,不会把写入之前的结果存到新版本下
+        key = (sql,tuple(args) if args else (),size,raw,_read_versions(tables))
+        res = _results.get(key,None)
+    except TypeError:
+        _result_stats['uncacheable'] += 1
+        return await query(sql,args,size,raw)
+    if res is None:
+        res = await query(sql,args,size,raw)
+        rows = res[1] if raw else res
+        #刚写过的表,副本可能还未同步,不缓存从副本读到的结果
+        window = replica_window()
+        if len(rows) > _results_maxrows or (window and any(_table_write_at.get(t,0) > time.time() - window for t in tables)):
+            _result_stats['skipped'] += 1
+            return res
+        _results.set(key,res)
+    #dict 行各自复制一份,避免调用方修改缓存
+    return res if raw else [dict(r) for r in res]
+
+#查询结果缓存统计
+def result_cache_stats():
+    return dict(tables=len(_table_versions),maxrows=_results_maxrows,**dict(_results.stats(),**_result_stats))
+
+#*********************************** Batch Loader *********************************#*******
+
+#主键批量加载器: 同一轮事件循环中对同一模型发起的主键查询合并为一条 in 查询
+class BatchLoader(object):
+    def __init__(self,model,maxbatch=500):
+        self.model = model
+        self.maxbatch = maxbatch
+        self.batches = 0
+        self.keys = 0
+        self._pending = dict()
+        #本批调用方中最晚的截止时间,有调用方不限时则为 None
+        self._deadline = None
+
+    #返回该主键对应行(元组,不存在时为 None)的 future; pk 已按主键类型转换
+    def load(self,pk):
+        key = pk
+        deadline = _deadline.get()
+        if not self._pending:
+            self._deadline = deadline
+        elif self._deadline is not None:
+            self._deadline = max(self._deadline,deadline) if deadline is not None else None
+        fut = self._pending.get(key,None)
+        if fut is None:
+            loop = asyncio.get_event_loop()
+            fut = loop.create_future()
+            if not self._pending:
+                #在空的 context 中查询,不继承第一个调用方的事务、会话等状态
+                loop.call_soon(self._dispatch,context=contextvars.Context())
+            self._pending[key] = fut
+        return fut
+
+    def _dispatch(self):
+        #批量查询使用本批调用方中最晚的截止时间
+        _deadline.set(self._deadline)
+        pending,self._pending = self._pending,dict()
+        keys = list(pending.keys())
+        for i in range(0,len(keys),self.maxbatch):
+            chunk = keys[i:i+self.maxbatch]
+            asyncio.ensure_future(self._fetch(chunk,[pending[k] for k in chunk]))
+
+    async def _fetch(self,keys,futures):
+        self.batches += 1
+        self.keys += len(keys)
+        model = self.model
+        try:
+            sql = _statements.get((model.__table__,'find_many',len(keys)),model._build_find_many,len(keys))
+            #加载器已合并了同一时刻的 find,不再与正在执行的查询合并: 写入之后的 find 必须读到写入后的行
+            _,res = await select_rows(sql,keys,coalesce=False)
+        except Exception as e:
+            for fut in futures:
+                if not fut.done():
+                    fut.set_exception(e)
+            return
+        rows = dict((r[0],r) for r in res)
+        for key,fut in zip(keys,futures):
+            if not fut.done():
+                fut.set_result(rows.get(key,None))
+
+    def stats(self):
+        return dict(batches=self.batches,keys=self.keys,avg=round(self.keys / self.batches,2) if self.batches else 0)
+
+#各模型批量加载器的统计
+def loader_stats():
+    return dict((table,model.__loader__.stats()) for table,model in _models.items())
+
+#*********************************** Batch Writer *********************************#*******
+
+#写后批量插入(write-behind): delay 秒内提交的插入合并为一条多行 insert,在一个事务中写入;
+#每个调用方只等待自己那一行写入完成。排队的行数达到 maxqueue 时,新的插入等待前面的批次写完
+class BatchWriter(object):
+    def __init__(self,model,delay=0.005,maxbatch=100,maxqueue=1000):
+        self.model = model
+        self.delay = delay
+        self.maxbatch = min(maxbatch,maxqueue)
+        self.maxqueue = maxqueue
+        self.batches = 0
+        self.rows = 0
+        #合并写入失败后逐行重试的批次数
+        self.retries = 0
+        #因排队已满而等待的次数
+        self.waits = 0
+        self._slots = asyncio.Semaphore(maxqueue)
+        #已排队或正在写入的行数
+        self._queued = 0
+        self._pending = []
+        self._timer = None
+        self._tasks = set()
+
+    #排队插入一行,写入提交后返回; 调用方被取消时该行仍会写入
+    async def save(self,obj):
+        if self._slots.locked():
+            #排队已满时不再等待定时器,立即写入
+            self.waits += 1
+            self._flush()
+        await self._slots.acquire()
+        self._queued += 1
+        fut = asyncio.get_event_loop().create_future()
+        self._pending.append((obj,fut))
+        if len(self._pending) >= self.maxbatch:
+            self._flush()
+        elif self._timer is None:
+            #在空的 context 中写入,不继承第一个调用方的会话、截止时间等状态
+            self._timer = asyncio.get_event_loop().call_later(self.delay,self._flush,context=contextvars.Context())
+        res = await asyncio.shield(fut)
+        #写入在空的 context 中执行,在调用方的会话中记录写入,之后 sticky 秒内的读请求发往主库
+        _mark_write()
+        return res
+
+    def _flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        while self._pending:
+            batch,self._pending = self._pending[:self.maxbatch],self._pending[self.maxbatch:]
+            task = contextvars.Context().run(asyncio.ensure_future,self._write(batch))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def _write(self,batch):
+        self.batches += 1
+        self.rows += len(batch)
+        try:
+            await self.model.save_many([obj for obj,_ in batch],batch_size=self.maxbatch)
+            for obj,fut in batch:
+                if not fut.done():
+                    fut.set_result(obj)
+        except Exception as e:
+            #一行出错会使整批回滚,逐行重试以便只有出错的调用方收到异常
+            logging.warning('batch insert into %s failed, retrying row by row: %s'%(self.model.__table__,e))
+            self.retries += 1
+            for obj,fut in batch:
+                try:
+                    await obj.save()
+                except Exception as e:
+                    if not fut.done():
+                        fut.set_exception(e)
+                else:
+                    if not fut.done():
+                        fut.set_result(obj)
+        finally:
+            self._queued -= len(batch)
+            for _ in batch:
+                self._slots.release()
+            #所有调用方都已取消时,取走异常避免未处理异常的警告
+            for _,fut in batch:
+                if fut.done() and not fut.cancelled():
+                    fut.exception()
+
+    #立即写入排队的行,并等待正在写入的批次完成
+    async def close(self):
+        self._flush()
+        if self._tasks:
+            await asyncio.gather(*self._tasks,return_exceptions=True)
+
+    def stats(self):
+        return dict(queued=self._queued,batches=self.batches,rows=self.rows,avg=round(self.rows / self.batches,2) if self.batches else 0,retries=self.retries,waits=self.waits)
+
+#各模型写后批量插入的统计
+def writer_stats():
+    return dict((table,model.__writer__.stats()) for table,model in _models.items() if model.__writer__ is not None)
+
+#写入所有排队的行,关闭连接池前调用
+async def flush_writers():
+    for model in _models.values():
+        if model.__writer__ is not None:
+            await model.__writer__.close()
+
+#*********************************** Fan-out **************************************#*******
+
+#并发执行相互独立的查询(协程),每个查询使用各自的连接,limit 为同时占用的连接数上限;
+#按传入顺序返回结果,任一查询失败时取消其余查询。事务只有一个连接,在事务中改为依次执行
+async def gather(*aws,limit=4):
+    if _transaction.get() is not None:
+        return [await aw for aw in aws]
+    semaphore = asyncio.Semaphore(limit)
+    async def run(aw):
+        async with semaphore:
+            return await aw
+    tasks = [asyncio.ensure_future(run(aw)) for aw in aws]
+    try:
+        return await asyncio.gather(*tasks)
+    except BaseException:
+        for task in tasks:
+            task.cancel()
+        raise
+
+#*********************************** Schema Migration *****************************#*******
+
+#对比模型声明的表和索引与数据库的实际结构,返回缺少的表和索引的 DDL
+#列相同且唯一性相同的已有索引视为满足声明,不论名称; 数据库中多出的索引只记录日志,不删除
+async def schema_diff(models=None):
+    models = list(_models.values()) if models is None else models
+    tables = await _backend.tables()
+    ddl = []
+    for model in models:
+        if model.__table__ in tables:
+            live = await _backend.indexes(model.__table__)
+        else:
+            ddl.append(_backend.create_table(model))
+            live = dict()
+        have = set(live.values())
+        for index in model.__indexes__:
+            if (index.unique,index.columns) not in have:
+                ddl.append(_backend.create_index(model.__table__,index))
+        declared = set((i.unique,i.columns) for i in model.__indexes__)
+        for name,(unique,columns) in live.items():
+            if (unique,columns) not in declared:
+                logging.info('index %s on %s(%s) is not declared by model %s'%(name,model.__table__,','.join(columns),model.__name__))
+    return ddl
+
+#生成缺少的表和索引的 DDL, apply=True 时依次执行,返回 DDL 列表
+async def migrate(models=None,apply=False):
+    ddl = await schema_diff(models)
+    if apply:
+        for sql in ddl:
+            await execute(sql,())
+    return ddl
+
+#按模型的当前声明重建一张表(如主键由字符串改为整数): 建立新表,逐批复制旧表的行后替换旧表
+#convert(row) 返回新表中的行(列顺序与 model.__columns__ 相同),返回 None 时丢弃该行; 返回 (复制行数,丢弃行数)
+#重建期间表上没有二级索引,之后由 migrate() 补建; 应在停止服务后执行
+async def rebuild_table(model,convert,batch=500):
+    table = model.__table__
+    columns = model.__columns__
+    await execute('drop table if exists %s_new'%table,())
+    await execute(_backend.create_table(model,'%s_new'%table),())
+    sql = 'insert into %s_new(%s)values '%(table,','.join(columns))
+    row = '(%s)'%','.join(['?']*len(columns))
+    copied,skipped = 0,0
+    async for res in select_iter('select %s from %s'%(','.join(columns),table),(),batch=batch,raw=True):
+        rows = [r for r in map(convert,res) if r is not None]
+        skipped += len(res) - len(rows)
+        if rows:
+            await execute(sql + ','.join([row]*len(rows)),[v for r in rows for v in r])
+            copied += len(rows)
+    await execute(_backend.rename_table(table,'%s_old'%table),())
+    await execute(_backend.rename_table('%s_new'%table,table),())
+    await execute('drop table %s_old'%table,())
+    logging.info('rebuilt table %s: %s rows copied, %s rows skipped'%(table,copied,skipped))
+    return copied,skipped
+
+#*********************************** ID Generator *********************************#*******
+
+#64 位有序 id(snowflake): 41 位毫秒时间戳(自 _ID_EPOCH 起) + 10 位节点号 + 12 位序号
+#同一节点每毫秒最多生成 4096 个,各进程使用不同的节点号(见 ids.py 的节点租约)即可保证全局唯一
+_ID_EPOCH = 1577836800000       #2020-01-01 00:00:00 UTC
+_NODE_BITS = 10
+_SEQUENCE_BITS = 12
+MAX_NODE = (1 << _NODE_BITS) - 1
+_MAX_SEQUENCE = (1 << _SEQUENCE_BITS) - 1
+
+class Snowflake(object):
+    def __init__(self,node):
+        if not 0 <= node <= MAX_NODE:
+            raise ValueError('Invalid id node:%s'%node)
+        self.node = node
+        self.last = 0
+        self.sequence = 0
+        self.generated = 0
+        #一毫秒内序号用完时借用下一毫秒的次数
+        self.borrowed = 0
+        #早于 _ID_EPOCH 的时间按 _ID_EPOCH 生成的次数
+        self.clamped = 0
+        #节点号的有效期(time.time()),过期后不再生成 id; None 为不过期
+        self.expire = None
+        #节点号过期时拒绝生成的次数
+        self.refused = 0
+
+    def __call__(self):
+        if self.expire is not None and time.time() > self.expire:
+            #租约没有按时续约,节点号可能已被其他进程接管,继续生成会产生重复的 id
+            self.refused += 1
+            raise RuntimeError('id node %s lease expired'%self.node)
+        return self.at(time.time())
+
+    #按给定时间(秒)生成 id; 时间早于上一个 id 时沿用上一个 id 的时间戳继续递增,保证同一节点生成的 id 单调递增
+    #早于 _ID_EPOCH 的时间无法表示(会得到负数),按 _ID_EPOCH 生成
+    def at(self,timestamp):
+        now = int(timestamp * 1000)
+        if now < _ID_EPOCH:
+            now = _ID_EPOCH
+            self.clamped += 1
+        if now > self.last:
+            self.last = now
+            self.sequence = 0
+        elif self.sequence < _MAX_SEQUENCE:
+            self.sequence += 1
+        else:
+            self.last += 1
+            self.sequence = 0
+            self.borrowed += 1
+        self.generated += 1
+        return ((self.last - _ID_EPOCH) << (_NODE_BITS + _SEQUENCE_BITS)) | (self.node << _SEQUENCE_BITS) | self.sequence
+
+    def stats(self):
+        return dict(node=self.node,generated=self.generated,borrowed=self.borrowed,refused=self.refused,
+            expire=round(self.expire - time.time(),1) if self.expire is not None else None)
+
+#id 中的时间戳(秒)
+def id_time(id):
+    return ((id >> (_NODE_BITS + _SEQUENCE_BITS)) + _ID_EPOCH) / 1000
+
+#没有取得节点租约的进程(如命令行脚本)使用保留的最后一个节点号
+_ids = Snowflake(MAX_NODE)
+
+#生成新 id,用作 IntegerField 主键的默认值; 节点租约过期时抛出 RuntimeError
+def next_id():
+    return _ids()
+
+#切换本进程使用的节点号,新的生成器从当前时间开始; expire 为节点号的有效期(time.time()),None 为不过期
+def set_id_node(node,expire=None):
+    global _ids
+    last = _ids.last
+    _ids = Snowflake(node)
+    _ids.expire = expire
+    #不早于旧生成器已用过的时间戳,避免节点号换回来时生成重复的 id
+    _ids.last = last
+    _ids.sequence = _MAX_SEQUENCE
+
+#延长节点号的有效期(续约成功后调用)
+def set_id_expire(expire):
+    _ids.expire = expire
+
+def id_stats():
+    return _ids.stats()
+
 #**************************************** ORM *********************************************
 
 # 字段父类
 class Field(object):
     #name为字段名('id'),column为字段类型('bigint'),
     #primary_key为字段是否为主键(True/False),default为字段默认值
-    def __init__(self,name,column,primary_key,default):
+    #deferred为列表查询时是否默认不加载该字段
+    #index/unique为是否在该字段上建立普通/唯一索引
+    def __init__(self,name,column,primary_key,default,deferred=False,index=False,unique=False):
         self.name = name
         self.column = column
         self.primary_key = primary_key
         self.default = default
+        self.deferred = deferred
+        self.index = index
+        self.unique = unique
 
     def __str__(self):
         return '<%s:%s:%s>'%(self.__class__.__name__,self.name,self.column)
 
-# Integer 字段
+    #把外部传入的取值(如 URL 中的 id)转换为字段的类型,无法转换时抛出 ValueError
+    def cast(self,value):
+        return value
+
+# Integer 字段, 用作主键时可以 default=next_id 生成 64 位有序 id
 class IntegerField(Field):
-    def __init__(self,name=None,column='bigint',primary_key=False,default=None):
-        super(IntegerField,self).__init__(name,column,primary_key,default)
+    def __init__(self,name=None,column='bigint',primary_key=False,default=None,index=False,unique=False):
+        super(IntegerField,self).__init__(name,column,primary_key,default,index=index,unique=unique)
+
+    def cast(self,value):
+        if value is None or isinstance(value,int):
+            return value
+        return int(value)
 
 # String 字段
 class StringField(Field):
-    def __init__(self,name=None,column='varchar(100)',primary_key=False,default=None):
-        super(StringField,self).__init__(name,column,primary_key,default)
+    def __init__(self,name=None,column='varchar(100)',primary_key=False,default=None,index=False,unique=False):
+        super(StringField,self).__init__(name,column,primary_key,default,index=index,unique=unique)
+
+    def cast(self,value):
+        if value is None or isinstance(value,str):
+            return value
+        return str(value)
 
 # Boolean 字段
 class BooleanField(Field):
-    def __init__(self,name=None,column='boolean',primary_key=False,default=False):
-        super(BooleanField,self).__init__(name,column,False,default)
+    def __init__(self,name=None,column='boolean',primary_key=False,default=False,index=False,unique=False):
+        super(BooleanField,self).__init__(name,column,False,default,index=index,unique=unique)
 
 # Float 字段
 class FloatField(Field):
-    def __init__(self,name=None,column='real',primary_key=False,default=None):
-        super(FloatField,self).__init__(name,column,primary_key,default)
+    def __init__(self,name=None,column='real',primary_key=False,default=None,index=False,unique=False):
+        super(FloatField,self).__init__(name,column,primary_key,default,index=index,unique=unique)
 
-# Text 字段
+# Text 字段, deferred=True 时 findall 默认不加载,需要时再通过 load/load_deferred 读取
 class TextField(Field):
-    def __init__(self,name=None,column='text',primary_key=False,default=None):
-        super(TextField,self).__init__(name,column,False,default)
+    def __init__(self,name=None,column='text',primary_key=False,default=None,deferred=False):
+        super(TextField,self).__init__(name,column,False,default,deferred)
+
+# 索引, 在模型的 __indexes__ 中声明组合索引,如 __indexes__ = (Index('blog_id','create_at'),)
+# name 默认为 表名单数_列名(如 comment_blog_id_create_at)
+class Index(object):
+    def __init__(self,*columns,unique=False,name=None):
+        if not columns:
+            raise ValueError('Index needs at least one column')
+        self.columns = tuple(columns)
+        self.unique = unique
+        self.name = name
+
+    def __str__(self):
+        return '<%s%s:%s(%s)>'%('Unique' if self.unique else '',self.__class__.__name__,self.name,','.join(self.columns))
 
 #元类
 class ModelMetaclass(type):
@@ -147,30 +1659,165 @@ class ModelMetaclass(type):
         attrs['__fields__'] = fields
         #选择数据
         attrs['__select__'] = 'select %s,%s from %s'%(primarykey,','.join(fields),tableName)
+        #根据主键查询
+        attrs['__find__'] = '%s where %s=? limit 1'%(attrs['__select__'],primarykey)
         #插入新数据
         attrs['__insert__'] = 'insert into %s(%s,%s)values (%s)'%(tableName,primarykey,','.join(fields),','.join(parameters))
         #根据主键更新记录 
         attrs['__update__'] = 'update %s set %s where %s=?'%(tableName,','.join(field_exp),primarykey)
         #根据主键删除记录
         attrs['__delete__'] = 'delete from %s where %s=?'%(tableName,primarykey)
-        return type.__new__(cls,name,bases,attrs)
+        #字段上声明的单列索引与 __indexes__ 中声明的组合索引
+        indexes = [Index(k,unique=v.unique) for k,v in mappings.items() if (v.index or v.unique) and not v.primary_key]
+        indexes.extend(attrs.get('__indexes__',()))
+        prefix = tableName[:-1] if tableName.endswith('s') else tableName
+        for index in indexes:
+            for c in index.columns:
+                if c not in mappings:
+                    raise RuntimeError('Index column not found:%s.%s'%(tableName,c))
+            if index.name is None:
+                index.name = '%s_%s'%(prefix,'_'.join(index.columns))
+        attrs['__indexes__'] = tuple(indexes)
+        #需要按列值维护记录数的列,如 Comment 的 blog_id
+        attrs['__counters__'] = tuple(attrs.get('__counters__',()))
+        #主键查询缓存,__cache__ 形如 dict(size=1000,ttl=300)
+        cache = attrs.get('__cache__',None)
+        attrs['__rowcache__'] = LRUCache(cache.get('size',1000),cache.get('ttl',None)) if cache else None
+        #__querycache__ = True 时列表查询(findall/findseek/findnum)默认使用查询结果缓存
+        attrs['__querycache__'] = attrs.get('__querycache__',False)
+        #按列的顺序(主键在前)为每个字段生成一个 slot,实例不再需要逐行的 dict
+        attrs['__columns__'] = tuple([primarykey] + fields)
+        #列表查询默认不加载的字段
+        attrs['__deferred__'] = tuple(k for k in fields if mappings[k].deferred)
+        #_changed 记录从数据库加载后被修改过的字段: 未赋值表示新建的实例,None 表示没有修改
+        attrs['__slots__'] = attrs['__columns__'] + ('_changed',)
+        model = type.__new__(cls,name,bases,attrs)
+        model._load = _make_loader(model,model.__columns__)
+        model.__loader__ = BatchLoader(model)
+        #写后批量插入,__writebehind__ 形如 dict(delay=0.005,maxbatch=100,maxqueue=1000),见 save_batched
+        writebehind = attrs.get('__writebehind__',None)
+        model.__writer__ = BatchWriter(model,**writebehind) if writebehind is not None else None
+        #其他字段组合(如不加载 deferred 字段时)的构造函数
+        model.__loaders__ = dict()
+        #数据变更的监听函数,见 Model.listen
+        model.__listeners__ = []
+        _models[tableName] = model
+        return model
+
+#生成从元组行(列顺序与 columns 相同)构造模型实例的函数,直接写入各字段的 slot
+def _make_loader(model,columns):
+    namespace = dict(new=object.__new__,model=model)
+    lines = ['def _load(row):','    self = new(model)']
+    for i,k in enumerate(columns):
+        namespace['set_%s'%i] = model.__dict__[k].__set__
+        lines.append('    set_%s(self,row[%s])'%(i,i))
+    namespace['set_changed'] = model.__dict__['_changed'].__set__
+    lines.append('    set_changed(self,None)')
+    lines.append('    return self')
+    exec('\n'.join(lines),namespace)
+    return namespace['_load']
+
+#表示属性不存在
+_MISSING = object()
 
 #Model
-class Model(dict,metaclass=ModelMetaclass):
+#字段保存在元类生成的 slot 中,其他属性(如 html_content)保存在实例的 __dict__ 中;
+#通过 keys()/__getitem__ 提供映射视图,dict(model) 及 json 序列化时按需生成
+class Model(metaclass=ModelMetaclass):
     def __init__(self,**kw):
-        super(Model,self).__init__(**kw)
-    
-    #增加 instance.key=value 的功能
+        for k,v in kw.items():
+            setattr(self,k,v)
+
+    #修改从数据库加载的实例的字段时,记录被修改的字段
     def __setattr__(self,key,value):
-        self[key] = value
+        if key in self.__mappings__:
+            try:
+                changed = self._changed
+            except AttributeError:
+                #新建的实例,不记录
+                object.__setattr__(self,key,value)
+                return
+            if getattr(self,key,_MISSING) != value:
+                if changed is None:
+                    object.__setattr__(self,'_changed',{key})
+                else:
+                    changed.add(key)
+        object.__setattr__(self,key,value)
+
+    #是否为从数据库加载的实例
+    def _loaded(self):
+        return getattr(self,'_changed',_MISSING) is not _MISSING
+
+    #标记为与数据库一致
+    def _mark_clean(self):
+        object.__setattr__(self,'_changed',None)
 
-    #增加获取 instance.key 值的功能
+    #未赋值的字段
     def __getattr__(self,key):
+        if key in self.__deferred__:
+            raise AttributeError('deferred field %s of \'%s\' is not loaded, use load() or load_deferred() first'%(key,self.__class__.__name__))
+        raise AttributeError('\'%s\' object has no attribution %s'%(self.__class__.__name__,key))
+
+    #由查询结果构造实例列表,查询的都是模型字段时使用为这组列生成的构造函数
+    @classmethod
+    def _load_rows(cls,columns,rows):
+        if columns == cls.__columns__:
+            load = cls._load
+        else:
+            load = cls.__loaders__.get(columns,None)
+            if load is None:
+                if not all(k in cls.__mappings__ for k in columns):
+                    return [cls._load_columns(columns,r) for r in rows]
+                load = cls.__loaders__[columns] = _make_loader(cls,columns)
+        return [load(r) for r in rows]
+
+    #按列名和元组行构造实例,用于自定义 select 字段的查询
+    @classmethod
+    def _load_columns(cls,columns,row):
+        self = object.__new__(cls)
+        for k,v in zip(columns,row):
+            object.__setattr__(self,k,v)
+        self._mark_clean()
+        return self
+
+    #映射视图: 已赋值的字段和其他属性
+    def keys(self):
+        keys = [k for k in self.__columns__ if hasattr(self,k)]
+        keys.extend(self.__dict__)
+        return keys
+
+    def __getitem__(self,key):
         try:
-            return self[key]
-        except:
-            raise AttributeError('\'Model\' object has no attribution %s'%key)
+            return getattr(self,key)
+        except AttributeError:
+            raise KeyError(key)
+
+    def __setitem__(self,key,value):
+        setattr(self,key,value)
+
+    def __contains__(self,key):
+        return hasattr(self,key)
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.keys())
+
+    def get(self,key,default=None):
+        return getattr(self,key,default)
+
+    def items(self):
+        return [(k,getattr(self,k)) for k in self.keys()]
+
+    def __repr__(self):
+        return '%s(%s)'%(self.__class__.__name__,', '.join('%s=%r'%kv for kv in self.items()))
     
+    #按字段类型转换取值,如 URL 中的字符串 id 转为整数
+    @classmethod
+    def cast(cls,key,value):
+        return cls.__mappings__[key].cast(value)
+
     #获取key对应的value
     def getValue(self,key):
         return getattr(self,key,None)
@@ -188,46 +1835,226 @@ class Model(dict,metaclass=ModelMetaclass):
 
     #选出表格中所有记录
     @classmethod
-    async def findnum(cls,selectField,where=None):
-        sql = 'select %s from %s'%(selectField,cls.__table__)
-        if where:
-            sql ='%s where %s'%(sql,where)
-        res = await select(sql)
+    async def findnum(cls,selectField,where=None,args=None,cache=None):
+        sql = _statements.get((cls.__table__,'findnum',selectField,where),cls._build_select,selectField,where,None,None)
+        res = await select(sql,args,cache=cls.__querycache__ if cache is None else cache)
         if len(res) == 0:
             return 
         return res
 
-    #根据主键查询
+    #读取记录数,优先使用计数器; column/value 指定按某列取值过滤
+    @classmethod
+    async def count(cls,column=None,value=None):
+        if column:
+            value = cls.cast(column,value)
+        key = (cls.__table__,column,value)
+        num = _counter.get(key)
+        if num is None:
+            num = await cls._count(column,value)
+            _counter.set(key,num)
+        return num
+
+    #从数据库查询记录数; 不使用查询结果缓存,核对计数时才能读到其他进程的写入
+    @classmethod
+    async def _count(cls,column=None,value=None):
+        if column:
+            res = await cls.findnum('count(%s) _num'%cls.__primary_key__,'%s=?'%column,[value],cache=False)
+        else:
+            res = await cls.findnum('count(%s) _num'%cls.__primary_key__,cache=False)
+        return res[0]['_num']
+
+    #增减计数器中与本条记录相关的计数,事务中的写入在提交后才计入
+    def _count_delta(self,delta):
+        after_commit(self._add_counts,delta)
+
+    def _add_counts(self,delta):
+        _counter.add((self.__table__,None,None),delta)
+        for column in self.__counters__:
+            _counter.add((self.__table__,column,self.getValue(column)),delta)
+
+    #根据主键查询,主键唯一故只取一行
+    #依次查找请求内的 identity map、模型的主键缓存和数据库
     @classmethod
     async def find(cls,pk):
-        sql = '%s where %s=?'%(cls.__select__,cls.__primary_key__)
-        res = await select(sql,[pk],1)
-        if len(res) == 0:
+        #类型不符的主键(如整数主键传入了非数字)不可能存在
+        try:
+            pk = cls.cast(cls.__primary_key__,pk)
+        except (TypeError,ValueError):
             return None
-        return cls(**res[0])
+        idmap = _identity.get()
+        if idmap is not None:
+            obj = idmap.get((cls.__table__,pk),None)
+            if obj is not None:
+                return obj
+        #事务中可能读到未提交的数据,不使用缓存
+        cache = cls.__rowcache__ if _transaction.get() is None else None
+        row = cache.get(pk) if cache is not None else None
+        if row is None:
+            generation = cache.generation if cache is not None else 0
+            #事务中或需要读主库时单独查询,否则交给批量加载器与同一时刻的其他 find 合并
+            if _transaction.get() is not None or _sticky():
+                columns,res = await select_rows(cls.__find__,[pk])
+                row = res[0] if res else None
+            else:
+                row = await _wait_deadline(asyncio.shield(cls.__loader__.load(pk)),'%s.find'%cls.__name__)
+            if row is None:
+                return None
+            #查询期间该缓存有过失效,或最近的写入可能还没同步到只读副本时,结果可能已过期,不放入缓存
+            if cache is not None and cache.generation == generation and time.time() - cache.invalidated_at > replica_window():
+                cache.set(pk,row)
+        #缓存中保存原始行,每次构造新对象,避免调用方修改缓存内容
+        obj = cls._load(row)
+        if idmap is not None:
+            idmap[(cls.__table__,pk)] = obj
+        return obj
+
+    #监听数据变更: 写入提交后调用 fn(event,pk,obj)
+    #event 为 'save'(插入/更新,obj 为写入的实例)、'remove'(obj 为 None) 或 'removeall'(pk 和 obj 都为 None)
+    @classmethod
+    def listen(cls,fn):
+        cls.__listeners__.append(fn)
+
+    @classmethod
+    def _emit(cls,event,pk=None,obj=None):
+        for fn in cls.__listeners__:
+            after_commit(fn,event,pk,obj)
+
+    #写操作后使主键缓存失效,并同步 identity map
+    #事务提交前其他连接仍可能读到旧数据并放入缓存,提交后再失效一次
+    def _invalidate(self,pk,removed=False):
+        if self.__rowcache__ is not None:
+            self.__rowcache__.pop(pk)
+            after_commit(self.__rowcache__.pop,pk)
+        idmap = _identity.get()
+        if idmap is not None:
+            if removed:
+                idmap.pop((self.__table__,pk),None)
+            else:
+                idmap[(self.__table__,pk)] = self
 
     #全查询
+    #未指定 selectField 时,only 指定只加载哪些字段,defer 指定额外不加载哪些字段,deferred 字段默认不加载
+    #coalesce=False 时不与正在执行的相同查询合并; cache 指定是否使用查询结果缓存,默认取决于模型的 __querycache__
     @classmethod
     async def findall(cls,selectField=None,where=None,args=None,**kw):
+        if not selectField:
+            selectField = cls._projection(kw.get('only',None),kw.get('defer',None))
+        orderby = kw.get('orderby',None)
+        limit = kw.get('limit',None)
+        #limit 同样作为参数绑定,不同页码共用一条语句
+        args = list(args) if args else []
+        if not limit:
+            shape = None
+        elif isinstance(limit,int):
+            shape = 1
+            args.append(limit)
+        elif isinstance(limit,tuple) and len(limit) == 2:
+            shape = 2
+            args.extend(limit)
+        else:
+            raise ValueError('Invalid limit value:%s'%limit)
+        sql = _statements.get((cls.__table__,'findall',selectField,where,orderby,shape),cls._build_select,selectField,where,orderby,shape)
+        cache = kw.get('cache',None)
+        columns,res = await select_rows(sql,args,coalesce=kw.get('coalesce',True),cache=cls.__querycache__ if cache is None else cache)
+        return cls._load_rows(columns,res)
+
+    #游标(seek)分页: 按(key,主键)倒序,取排在after=(key值,主键值)之后的limit条记录
+    #无论翻到第几页,都只扫描本页的行
+    @classmethod
+    async def findseek(cls,key,after=None,limit=10,where=None,args=None,only=None,defer=None,cache=None):
+        selectField = cls._projection(only,defer)
+        args = list(args) if args else []
+        if after is not None:
+            seek = '(%s<? or (%s=? and %s<?))'%(key,key,cls.__primary_key__)
+            where = '(%s) and %s'%(where,seek) if where else seek
+            args.extend((after[0],after[0],cls.cast(cls.__primary_key__,after[1])))
+        args.append(limit)
+        orderby = '%s desc,%s desc'%(key,cls.__primary_key__)
+        sql = _statements.get((cls.__table__,'findall',selectField,where,orderby,1),cls._build_select,selectField,where,orderby,1)
+        columns,res = await select_rows(sql,args,cache=cls.__querycache__ if cache is None else cache)
+        return cls._load_rows(columns,res)
+
+    #列表查询要加载的字段,返回 None 表示加载全部字段
+    @classmethod
+    def _projection(cls,only=None,defer=None):
+        if only is not None:
+            columns = [cls.__primary_key__] + [k for k in cls.__fields__ if k in only]
+        else:
+            skip = set(cls.__deferred__)
+            if defer:
+                skip.update(defer)
+            columns = [k for k in cls.__columns__ if k not in skip]
+        if len(columns) == len(cls.__columns__):
+            return None
+        return ','.join(columns)
+
+    #批量加载实例中尚未加载的字段(默认为全部 deferred 字段),每500个主键合并为一条 in 查询
+    @classmethod
+    async def load_deferred(cls,models,columns=None):
+        columns = tuple(columns or cls.__deferred__)
+        pending = dict()
+        for m in models:
+            for k in columns:
+                if not hasattr(m,k):
+                    pending.setdefault(getattr(m,cls.__primary_key__),[]).append(m)
+                    break
+        pks = list(pending.keys())
+        for i in range(0,len(pks),500):
+            chunk = pks[i:i+500]
+            sql = _statements.get((cls.__table__,'load_deferred',columns,len(chunk)),cls._build_load,columns,len(chunk))
+            _,res = await select_rows(sql,chunk)
+            for row in res:
+                for m in pending.get(row[0],()):
+                    for k,v in zip(columns,row[1:]):
+                        object.__setattr__(m,k,v)
+        return models
+
+    #加载本实例尚未加载的字段
+    async def load(self,*columns):
+        await self.load_deferred([self],columns)
+        return self
+
+    @classmethod
+    def _build_find_many(cls,n):
+        return '%s where %s in (%s)'%(cls.__select__,cls.__primary_key__,','.join(['?']*n))
+
+    @classmethod
+    def _build_load(cls,columns,n):
+        return 'select %s,%s from %s where %s in (%s)'%(cls.__primary_key__,','.join(columns),cls.__table__,cls.__primary_key__,','.join(['?']*n))
+
+    #流式遍历表中记录,每次从服务端取batch行,用法: async for m in Model.iter_all(...)
+    @classmethod
+    async def iter_all(cls,where=None,args=None,batch=100,**kw):
+        orderby = kw.get('orderby',None)
+        sql = _statements.get((cls.__table__,'findall',None,where,orderby,None),cls._build_select,None,where,orderby,None)
+        load = cls._load
+        async for res in select_iter(sql,args,batch,raw=True):
+            for r in res:
+                yield load(r)
+
+    #构造查询语句,shape为limit参数个数
+    @classmethod
+    def _build_select(cls,selectField,where,orderby,shape):
         if selectField:
             sql = 'select %s from %s'%(selectField,cls.__table__)
         else:
             sql = cls.__select__
         if where:
             sql = '%s where %s'%(sql,where)
-        orderby = kw.get('orderby',None)
-        if orderby is  not None:
+        if orderby is not None:
             sql = '%s order by %s'%(sql,orderby)
-        limit = kw.get('limit',None)
-        if limit:
-            if isinstance(limit,int):
-                sql = '%s limit %s'%(sql,limit)
-            elif isinstance(limit,tuple) and len(limit) == 2:
-                sql = '%s limit %s,%s'%(sql,limit[0],limit[1])
-            else:
-                raise ValueError('Invalid limit value:%s'%limit)
-        res = await select(sql,args)
-        return [cls(**r) for r in res]
+        if shape == 1:
+            sql = '%s limit ?'%sql
+        elif shape == 2:
+            sql = '%s limit ?,?'%sql
+        return sql
+
+    #写后批量插入: 与短时间内的其他插入合并写入,写入提交后返回; 模型没有声明 __writebehind__ 或在事务中时直接 save
+    async def save_batched(self):
+        if self.__writer__ is None or _transaction.get() is not None:
+            await self.save()
+            return self
+        return await self.__writer__.save(self)
 
     #插入数据
     async def save(self):
@@ -236,27 +2063,132 @@ class Model(dict,metaclass=ModelMetaclass):
             args.append(item)
         sql = self.__insert__
         res = await execute(sql,args)
+        self._invalidate(args[0])
         if res != 1:
-            logging.warn('failed to insert record: affected rows: %s'% rows) 
+            logging.warn('failed to insert record: affected rows: %s'% res) 
         else:
+            self._mark_clean()
+            self._count_delta(1)
+            self._emit('save',args[0],self)
             logging.info('success to insert one record to %s'%self.__table__)
 
+    #批量插入数据,每batch_size行合并为一条多行insert,所有批次在同一事务中提交
+    #返回每个批次的影响行数
+    @classmethod
+    async def save_many(cls,rows,batch_size=100):
+        if batch_size < 1:
+            raise ValueError('Invalid batch_size value:%s'%batch_size)
+        rows = [r if isinstance(r,cls) else cls(**r) for r in rows]
+        statements = []
+        for i in range(0,len(rows),batch_size):
+            batch = rows[i:i+batch_size]
+            args = []
+            for r in batch:
+                args.append(r.getValueOrDefault(cls.__primary_key__))
+                args.extend(map(r.getValueOrDefault,cls.__fields__))
+            sql = _statements.get((cls.__table__,'save_many',len(batch)),cls._build_insert,len(batch))
+            statements.append((sql,args))
+        if not statements:
+            return []
+        res = await execute_batch(statements)
+        for r in rows:
+            r._mark_clean()
+            r._count_delta(1)
+            cls._emit('save',r.getValue(cls.__primary_key__),r)
+        logging.info('success to insert %s records to %s'%(sum(res),cls.__table__))
+        return res
+
+    #按条件批量删除,返回删除的行数
+    @classmethod
+    async def removeall(cls,where,args=None):
+        sql = _statements.get((cls.__table__,'removeall',where),'delete from %s where %s'.__mod__,(cls.__table__,where))
+        res = await execute(sql,args)
+        #无法得知被删除行的取值,丢弃相关的计数和主键缓存,下次读取时重新查询
+        after_commit(_counter.forget,cls.__table__)
+        if cls.__rowcache__ is not None:
+            cls.__rowcache__.clear()
+            after_commit(cls.__rowcache__.clear)
+        cls._emit('removeall')
+        logging.info('success to remove %s records from %s'%(res,cls.__table__))
+        return res
+
+    #构造n行的insert语句
+    @classmethod
+    def _build_insert(cls,n):
+        row = '(%s)'%','.join(['?']*(len(cls.__fields__)+1))
+        return 'insert into %s(%s,%s)values %s'%(cls.__table__,cls.__primary_key__,','.join(cls.__fields__),','.join([row]*n))
+
     #根据主键更新数据
+    #从数据库加载的实例只更新修改过的字段,没有修改时不访问数据库;
+    #新建的实例更新所有已赋值的字段,未加载的 deferred 字段保持不变
     async def update(self,**kw):
-        args = list(map(self.getValue,self.__fields__))
+        fields = self._changed_fields()
+        if not fields:
+            logging.info('no changes to update by primary key:%s'%self.getValue(self.__primary_key__))
+            return
+        if len(fields) == len(self.__fields__):
+            sql = self.__update__
+        else:
+            sql = _statements.get((self.__table__,'update',fields),self._build_update,fields)
+        args = list(map(self.getValue,fields))
         args.append(self.getValue(self.__primary_key__))
-        res = await execute(self.__update__,args)
+        res = await execute(sql,args)
+        self._invalidate(args[-1])
         if res != 1:
             logging.warn('failed to update record by primary key:%s'%self.getValue(self.__primary_key__)) 
         else:
+            self._mark_clean()
+            self._emit('save',args[-1],self)
             logging.warn('success to update record by primary key:%s'%self.getValue(self.__primary_key__))
 
+    @classmethod
+    def _build_update(cls,fields):
+        return 'update %s set %s where %s=?'%(cls.__table__,','.join('%s=?'%k for k in fields),cls.__primary_key__)
+
+    #需要写回数据库的字段
+    def _changed_fields(self):
+        changed = getattr(self,'_changed',_MISSING)
+        if changed is _MISSING:
+            return tuple(k for k in self.__fields__ if hasattr(self,k))
+        if changed is None:
+            return ()
+        return tuple(k for k in self.__fields__ if k in changed)
+
+    #插入数据,主键已存在时改为更新(mysql 为 insert ... on duplicate key update)
+    #新建的实例更新所有已赋值的字段,从数据库加载的实例只更新修改过的字段,没有修改时不访问数据库
+    async def upsert(self):
+        fields = self._changed_fields()
+        if not fields:
+            logging.info('no changes to upsert by primary key:%s'%self.getValue(self.__primary_key__))
+            return
+        args = [self.getValueOrDefault(self.__primary_key__)]
+        args.extend(map(self.getValueOrDefault,self.__fields__))
+        sql = _statements.get((self.__table__,'upsert',fields),self._build_upsert,fields)
+        res = await execute(sql,args)
+        self._invalidate(args[0])
+        self._mark_clean()
+        #影响行数为1表示插入了新记录,为2表示更新了已有记录; 无法区分时丢弃该表的计数,由下次查询重新统计
+        if not _backend.upsert_rowcount:
+            after_commit(_counter.forget,self.__table__)
+        elif res == 1:
+            self._count_delta(1)
+        self._emit('save',args[0],self)
+        logging.info('success to upsert record by primary key:%s, affected rows: %s'%(args[0],res))
+
+    @classmethod
+    def _build_upsert(cls,fields):
+        return _backend.upsert(cls.__insert__,cls.__primary_key__,fields)
+
     #根据主键删除数据
     async def remove(self,pk):
+        pk = self.cast(self.__primary_key__,pk)
         sql = self.__delete__
         res = await execute(sql,[pk])
+        self._invalidate(pk,removed=True)
         if res != 1:
             logging.warn('failed to remove record by primary key:%s'%self.getValue(self.__primary_key__)) 
         else:
+            self._count_delta(-1)
+            self._emit('remove',pk)
             logging.warn('success to remove record by primary key:%s'%self.getValue(self.__primary_key__))
 
@@ -0,0 +1,245 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''
+    嵌入式 SQLite 后端: 提供与 aiomysql 相同用法的连接池、连接和游标,
+    每个连接在自己的线程中执行语句,不阻塞事件循环
+    用法: python3 orm_sqlite.py schema.sql awesome.db  (按 schema.sql 建表)
+'''
+
+import asyncio,collections,concurrent.futures,re,sqlite3,sys
+import logging
+
+OperationalError = sqlite3.OperationalError
+InterfaceError = sqlite3.InterfaceError
+IntegrityError = sqlite3.IntegrityError
+
+#*********************************** Cursor ***************************************#*******
+
+#游标: 语句在连接所属的线程中执行,结果以元组形式返回
+class Cursor(object):
+    def __init__(self,connection):
+        self._connection = connection
+        self._cursor = None
+        self.description = None
+        self.rowcount = -1
+        self.lastrowid = None
+
+    async def execute(self,sql,args=None):
+        self._cursor = await self._connection._run(self._execute,sql,tuple(args) if args else ())
+        self.description = self._cursor.description
+        self.rowcount = self._cursor.rowcount
+        self.lastrowid = self._cursor.lastrowid
+        return self.rowcount
+
+    def _execute(self,sql,args):
+        return self._connection._conn.execute(sql,args)
+
+    async def fetchall(self):
+        return self._rows(await self._connection._run(self._cursor.fetchall))
+
+    async def fetchmany(self,size):
+        return self._rows(await self._connection._run(self._cursor.fetchmany,size))
+
+    async def fetchone(self):
+        rows = await self.fetchmany(1)
+        return rows[0] if rows else None
+
+    def _rows(self,rows):
+        return rows
+
+    async def close(self):
+        if self._cursor is not None:
+            await self._connection._run(self._cursor.close)
+            self._cursor = None
+
+#以 dict 形式返回结果的游标
+class DictCursor(Cursor):
+    def _rows(self,rows):
+        columns = tuple(d[0] for d in self.description or ())
+        return [dict(zip(columns,row)) for row in rows]
+
+#SQLite 的游标本身就是逐批读取的,流式游标与普通游标相同
+SSCursor = Cursor
+SSDictCursor = DictCursor
+
+#*********************************** Connection ***********************************#*******
+
+#连接: 独占一个线程,同一连接上的语句按顺序执行
+class Connection(object):
+    def __init__(self,path,readonly=False,timeout=5):
+        self.path = path
+        self.readonly = readonly
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        #isolation_level=None: 默认自动提交,事务由 begin/commit 显式控制
+        if readonly:
+            self._conn = sqlite3.connect('file:%s?mode=ro'%path,uri=True,timeout=timeout,isolation_level=None,check_same_thread=False)
+        else:
+            self._conn = sqlite3.connect(path,timeout=timeout,isolation_level=None,check_same_thread=False)
+            #WAL 模式下读连接不会被写连接阻塞
+            self._conn.execute('pragma journal_mode=wal')
+            self._conn.execute('pragma synchronous=normal')
+
+    def _run(self,fn,*args):
+        return asyncio.get_running_loop().run_in_executor(self._executor,fn,*args)
+
+    async def cursor(self,cursorclass=Cursor):
+        return cursorclass(self)
+
+    async def begin(self):
+        await self._run(self._conn.execute,'begin immediate' if not self.readonly else 'begin')
+
+    async def commit(self):
+        await self._run(self._conn.commit)
+
+    async def rollback(self):
+        await self._run(self._conn.rollback)
+
+    async def ping(self):
+        await self._run(self._conn.execute,'select 1')
+
+    #中断正在执行的语句(可在其他线程调用)
+    def interrupt(self):
+        self._conn.interrupt()
+
+    def close(self):
+        self._conn.close()
+        self._executor.shutdown(wait=False)
+
+#*********************************** Pool *****************************************#*******
+
+#连接池: 启动时打开全部连接,acquire 在没有空闲连接时等待
+class Pool(object):
+    def __init__(self,connections):
+        self._free = collections.deque(connections)
+        self._waiters = collections.deque()
+        self._closed = False
+        self.maxsize = len(connections)
+
+    @property
+    def size(self):
+        return self.maxsize
+
+    @property
+    def freesize(self):
+        return len(self._free)
+
+    async def acquire(self):
+        while not self._free:
+            if self._closed:
+                raise InterfaceError('pool is closed')
+            waiter = asyncio.get_running_loop().create_future()
+            self._waiters.append(waiter)
+            try:
+                await waiter
+            except BaseException:
+                #被取消时把唤醒机会让给下一个等待者
+                if waiter.done() and not waiter.cancelled():
+                    self._wakeup()
+                raise
+            finally:
+                if waiter in self._waiters:
+                    self._waiters.remove(waiter)
+        return self._free.popleft()
+
+    async def release(self,connection):
+        self._free.append(connection)
+        self._wakeup()
+
+    def _wakeup(self):
+        while self._waiters:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                return
+
+    def close(self):
+        self._closed = True
+        for connection in self._free:
+            connection.close()
+        self._wakeup()
+
+    async def wait_closed(self):
+        pass
+
+#创建连接池: 写连接池只有一个连接(SQLite 同一时间只允许一个写事务); readonly 为 True 时打开只读连接
+async def create_pool(path,maxsize=1,readonly=False,timeout=5,**kw):
+    loop = asyncio.get_running_loop()
+    connections = []
+    for i in range(maxsize):
+        connections.append(await loop.run_in_executor(None,lambda: Connection(path,readonly=readonly,timeout=timeout)))
+    return Pool(connections)
+
+#*********************************** Dialect **************************************#*******
+
+#插入数据,主键已存在时改为更新
+def upsert(insert,primary_key,fields):
+    return '%s on conflict(%s) do update set %s'%(insert,primary_key,','.join('%s=excluded.%s'%(k,k) for k in fields))
+
+_RE_COMMENT = re.compile(r'--[^\n]*')
+_RE_SKIP = re.compile(r'^(drop|create)\s+database\b|^use\b',re.I)
+_RE_TABLE = re.compile(r'^create\s+table\s+(?:if\s+not\s+exists\s+)?`?(\w+)`?\s*\((.*)\)[^)]*$',re.I | re.S)
+_RE_INDEX = re.compile(r'^(unique\s+)?(?:key|index)\s+`?(\w+)`?\s*\((.*)\)$',re.I | re.S)
+_RE_UNIQUE = re.compile(r'^unique\s*\((.*)\)$',re.I | re.S)
+#SQLite 不支持的列属性
+_RE_COLUMN_OPTIONS = re.compile(r"\s+(?:auto_increment|unsigned|character\s+set\s+\w+|collate\s+\w+|comment\s+'(?:[^'\\]|\\.)*')",re.I)
+
+#按顶层逗号切分表定义
+def _split_definitions(body):
+    parts,depth,start = [],0,0
+    for i,c in enumerate(body):
+        if c == '(':
+            depth += 1
+        elif c == ')':
+            depth -= 1
+        elif c == ',' and depth == 0:
+            parts.append(body[start:i].strip())
+            start = i + 1
+    parts.append(body[start:].strip())
+    return [p for p in parts if p]
+
+#将 MySQL 的建表语句(schema.sql)转换为 SQLite 的 DDL
+#去掉建库语句和表选项,索引改为单独的 create index; 已存在的表和索引保持不变
+def translate_schema(text):
+    statements = []
+    for stmt in _RE_COMMENT.sub('',text).split(';'):
+        stmt = stmt.strip()
+        if not stmt or _RE_SKIP.match(stmt):
+            continue
+        m = _RE_TABLE.match(stmt)
+        if m is None:
+            statements.append(stmt)
+            continue
+        table,columns,indexes = m.group(1),[],[]
+        for d in _split_definitions(m.group(2)):
+            im = _RE_INDEX.match(d)
+            if im is not None:
+                indexes.append('create %sindex if not exists %s on %s(%s)'%('unique ' if im.group(1) else '',im.group(2),table,im.group(3).replace('`','')))
+                continue
+            um = _RE_UNIQUE.match(d)
+            if um is not None:
+                indexes.append('create unique index if not exists %s_%s on %s(%s)'%(table,'_'.join(c.strip() for c in um.group(1).replace('`','').split(',')),table,um.group(1).replace('`','')))
+                continue
+            columns.append(_RE_COLUMN_OPTIONS.sub('',d))
+        statements.append('create table if not exists %s(\n    %s\n)'%(table,',\n    '.join(columns)))
+        statements.extend(indexes)
+    return statements
+
+#按 schema.sql 在数据库文件中建表
+def init_schema(path,schema):
+    with open(schema,encoding='utf-8') as f:
+        statements = translate_schema(f.read())
+    conn = sqlite3.connect(path,isolation_level=None)
+    try:
+        conn.execute('pragma journal_mode=wal')
+        for stmt in statements:
+            logging.info('SQL:%s'%stmt)
+            conn.execute(stmt)
+    finally:
+        conn.close()
+
+if __name__ == '__main__':
+    if len(sys.argv) != 3:
+        print('usage: python3 orm_sqlite.py schema.sql awesome.db')
+        sys.exit(1)
+    init_schema(sys.argv[2],sys.argv[1])
@@ -21,7 +21,7 @@ CREATE TABLE users(
 )ENGINE=InnoDB DEFAULT CHARSET=utf8;
 
 CREATE TABLE blogs(
-    id VARCHAR(50) NOT NULL,
+    id BIGINT NOT NULL,
     user_id VARCHAR(50) NOT NULL,
     user_name VARCHAR(50) NOT NULL,
     user_image VARCHAR(500) NOT NULL,
@@ -34,14 +34,21 @@ CREATE TABLE blogs(
 )ENGINE=InnoDB DEFAULT CHARSET=utf8;
 
 CREATE TABLE comments(
-    id VARCHAR(50) NOT NULL,
-    blog_id VARCHAR(50) NOT NULL,
+    id BIGINT NOT NULL,
+    blog_id BIGINT NOT NULL,
     user_id VARCHAR(50) NOT NULL,
     user_name VARCHAR(50) NOT NULL,
     user_image VARCHAR(500) NOT NULL,
     content MEDIUMTEXT  NOT NULL,
     create_at REAL NOT NULL,
     PRIMARY KEY (id),
-    INDEX comment_create_at(create_at)
+    INDEX comment_create_at(create_at),
+    INDEX comment_blog_id_create_at(blog_id,create_at)
 )ENGINE=InnoDB DEFAULT CHARSET=utf8;
 
+CREATE TABLE id_nodes(
+    node INT NOT NULL,
+    owner VARCHAR(100) NOT NULL,
+    heartbeat REAL NOT NULL,
+    PRIMARY KEY (node)
+)ENGINE=InnoDB DEFAULT CHARSET=utf8;
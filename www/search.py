@@ -0,0 +1,236 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''
+    博客全文搜索: 进程内倒排索引, BM25 排序
+    中日韩文字按相邻两字切分(bigram),英文和数字按单词切分并转为小写
+    启动时从快照加载(没有快照时扫描 blogs 表建立),之后随 Blog 的写入增量更新,定期写回快照
+    只有正常退出时写下的快照才会被加载: 定期快照之后的修改在进程崩溃时会丢失,这时重新扫描建立
+'''
+
+import asyncio,collections,heapq,json,math,os,re,time
+import logging
+from models import Blog
+
+#中日韩文字(汉字、假名、谚文)的连续片段,或由字母数字组成的单词
+_RE_TOKEN = re.compile(r'[\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uac00-\ud7af\uf900-\ufaff]+|[0-9a-z]+')
+
+#切分文本: 中日韩片段取相邻两字,只有一个字时取单字
+def tokenize(text):
+    tokens = []
+    for m in _RE_TOKEN.finditer(text.lower()):
+        word = m.group()
+        if word[0] < '\u3040':
+            tokens.append(word)
+        elif len(word) == 1:
+            tokens.append(word)
+        else:
+            tokens.extend(word[i:i+2] for i in range(len(word) - 1))
+    return tokens
+
+#标题和摘要中的词按倍数计入词频
+_FIELD_WEIGHTS = (('name',3),('summary',2),('content',1))
+#搜索结果中返回的字段
+_META_FIELDS = ('name','summary','user_id','user_name','user_image','create_at')
+#快照格式版本,切分或加权方式改变时加一,旧快照将被丢弃
+_SNAPSHOT_VERSION = 2
+
+#统计一篇博客的加权词频
+def _term_counts(blog):
+    counts = collections.Counter()
+    for field,weight in _FIELD_WEIGHTS:
+        for t in tokenize(getattr(blog,field,None) or ''):
+            counts[t] += weight
+    return counts
+
+#倒排索引: 词 -> {博客id: 词频}
+class SearchIndex(object):
+    def __init__(self,k1=1.2,b=0.75):
+        self.k1 = k1
+        self.b = b
+        self.postings = dict()
+        #博客id -> 词频,删除或更新时据此从倒排表中移除
+        self.terms = dict()
+        #博客id -> 结果中返回的字段
+        self.meta = dict()
+        #博客id -> 文档长度(加权词数)
+        self.lengths = dict()
+        self.total_length = 0
+        self.dirty = False
+        self.path = None
+        self._tasks = set()
+
+    def __len__(self):
+        return len(self.terms)
+
+    #加入或更新一篇博客
+    def add(self,blog):
+        self._put(blog.id,_term_counts(blog),dict((k,getattr(blog,k,None)) for k in _META_FIELDS))
+
+    def _put(self,doc,counts,meta):
+        self.remove(doc)
+        for t,n in counts.items():
+            self.postings.setdefault(t,dict())[doc] = n
+        length = sum(counts.values())
+        self.terms[doc] = counts
+        self.meta[doc] = meta
+        self.lengths[doc] = length
+        self.total_length += length
+        self.dirty = True
+
+    def remove(self,doc):
+        counts = self.terms.pop(doc,None)
+        if counts is None:
+            return
+        for t in counts:
+            posting = self.postings.get(t,None)
+            if posting is not None:
+                posting.pop(doc,None)
+                if not posting:
+                    del self.postings[t]
+        self.meta.pop(doc,None)
+        self.total_length -= self.lengths.pop(doc,0)
+        self.dirty = True
+
+    def clear(self):
+        self.postings.clear()
+        self.terms.clear()
+        self.meta.clear()
+        self.lengths.clear()
+        self.total_length = 0
+        self.dirty = True
+
+    #计算与查询匹配的博客的 BM25 得分,返回 博客id -> 得分
+    def match(self,query):
+        n = len(self.terms)
+        if not n:
+            return dict()
+        avgdl = self.total_length / n
+        k1,b = self.k1,self.b
+        scores = collections.defaultdict(float)
+        for t in set(tokenize(query)):
+            posting = self.postings.get(t,None)
+            if not posting:
+                continue
+            idf = math.log(1 + (n - len(posting) + 0.5) / (len(posting) + 0.5))
+            for doc,tf in posting.items():
+                scores[doc] += idf * tf * (k1 + 1) / (tf + k1 * (1 - b + b * self.lengths[doc] / avgdl))
+        return scores
+
+    #按得分(相同时按发表时间)从高到低取出一页结果
+    def top(self,scores,offset=0,limit=10):
+        best = heapq.nlargest(offset + limit,scores.items(),key=lambda item: (item[1],self.meta[item[0]].get('create_at') or 0))
+        return [dict(id=doc,score=round(score,4),**self.meta[doc]) for doc,score in best[offset:]]
+
+    #启动: 从快照加载并与 blogs 表核对,没有快照时扫描全表建立; 之后监听 Blog 的写入并定期写回快照
+    async def start(self,path=None,interval=300):
+        self.path = path
+        Blog.listen(self._on_change)
+        start = time.time()
+        #取走正常退出的标记,之后再崩溃时不会误用本次运行中写下的快照
+        clean = path is not None and os.path.exists(_clean_marker(path))
+        if clean:
+            os.remove(_clean_marker(path))
+        elif path and os.path.exists(path):
+            logging.info('search snapshot %s was not saved at shutdown, rebuilding'%path)
+        if not (clean and await self._load_snapshot(path)):
+            await self.rebuild()
+        logging.info('search index ready: %s blogs, %s terms in %.1fs'%(len(self.terms),len(self.postings),time.time() - start))
+        if path and interval:
+            self._spawn(self._snapshot_loop(interval))
+
+    #扫描 blogs 表重建索引
+    async def rebuild(self):
+        self.clear()
+        async for blog in Blog.iter_all():
+            self.add(blog)
+
+    def _spawn(self,coro):
+        task = asyncio.ensure_future(coro)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return task
+
+    #Blog 写入提交后调用
+    def _on_change(self,event,pk,blog):
+        if event == 'remove':
+            self.remove(pk)
+        elif event == 'removeall':
+            self._spawn(self.rebuild())
+        elif all(hasattr(blog,k) for k,_ in _FIELD_WEIGHTS):
+            self.add(blog)
+        else:
+            #只更新了部分字段(如未加载 content),从数据库读取完整的行
+            self._spawn(self._reload(pk))
+
+    async def _reload(self,pk):
+        blogs = await Blog.findall(where='id=?',args=[pk],only=Blog.__fields__,cache=False)
+        if blogs:
+            self.add(blogs[0])
+        else:
+            self.remove(pk)
+
+    async def _load_snapshot(self,path):
+        if not os.path.exists(path):
+            return False
+        try:
+            with open(path,encoding='utf-8') as f:
+                data = json.load(f)
+        except (OSError,ValueError) as e:
+            logging.warning('failed to load search snapshot %s: %s'%(path,e))
+            return False
+        if data.get('version',None) != _SNAPSHOT_VERSION:
+            logging.info('search snapshot %s is outdated, rebuilding'%path)
+            return False
+        #json 对象的键都是字符串,按主键类型转换回来
+        for doc,(counts,meta) in data['docs'].items():
+            self._put(Blog.cast('id',doc),counts,meta)
+        #快照之后新增或删除的博客; 同一轮发起的 find 由批量加载器合并为 in 查询
+        ids = set(b.id for b in await Blog.findall('id',cache=False))
+        removed = set(self.terms) - ids
+        for doc in removed:
+            self.remove(doc)
+        missing = ids - set(self.terms)
+        for blog in await asyncio.gather(*[Blog.find(pk) for pk in missing]):
+            if blog is not None:
+                self.add(blog)
+        logging.info('search snapshot %s loaded, %s added, %s removed since snapshot'%(path,len(missing),len(removed)))
+        return True
+
+    #写回快照: 先写临时文件再替换,写文件不占用事件循环
+    #shutdown=True 时(退出前最后一次写回)同时写下正常退出的标记,下次启动时才会加载该快照
+    async def save_snapshot(self,shutdown=False):
+        if not self.path:
+            return
+        if self.dirty or not os.path.exists(self.path):
+            data = json.dumps(dict(version=_SNAPSHOT_VERSION,docs=dict((doc,(self.terms[doc],self.meta[doc])) for doc in self.terms)),ensure_ascii=False)
+            self.dirty = False
+            await asyncio.get_event_loop().run_in_executor(None,_write_file,self.path,data)
+            logging.info('search snapshot saved: %s blogs'%len(self.terms))
+        if shutdown:
+            await asyncio.get_event_loop().run_in_executor(None,_write_file,_clean_marker(self.path),'')
+
+    async def _snapshot_loop(self,interval):
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await self.save_snapshot()
+            except Exception as e:
+                self.dirty = True
+                logging.warning('failed to save search snapshot: %s'%e)
+
+    def stats(self):
+        return dict(blogs=len(self.terms),terms=len(self.postings),avg_length=round(self.total_length / len(self.terms),1) if self.terms else 0,dirty=self.dirty)
+
+#正常退出的标记文件
+def _clean_marker(path):
+    return '%s.clean'%path
+
+def _write_file(path,data):
+    tmp = '%s.tmp'%path
+    with open(tmp,'w',encoding='utf-8') as f:
+        f.write(data)
+    os.replace(tmp,path)
+
+#博客的搜索索引
+blog_index = SearchIndex()
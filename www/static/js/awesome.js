@@ -118,9 +118,14 @@ function parseQueryString() {
     return r;
 }
 
-function gotoPage(i) {
+function gotoPage(i, cursor) {
     var r = parseQueryString();
     r.page = i;
+    if (cursor) {
+        r.cursor = cursor;
+    } else {
+        delete r.cursor;
+    }
     location.assign('?' + $.param(r));
 }
 
@@ -363,7 +368,7 @@ if (typeof(Vue)!=='undefined') {
                 '<li v-if="has_previous"><a v-attr="onclick:\'gotoPage(\' + (page_index-1) + \')\'" href="#0"><i class="uk-icon-angle-double-left"></i></a></li>' +
                 '<li class="uk-active"><span v-text="page_index"></span></li>' +
                 '<li v-if="! has_next" class="uk-disabled"><span><i class="uk-icon-angle-double-right"></i></span></li>' +
-                '<li v-if="has_next"><a v-attr="onclick:\'gotoPage(\' + (page_index+1) + \')\'" href="#0"><i class="uk-icon-angle-double-right"></i></a></li>' +
+                '<li v-if="has_next"><a v-attr="onclick:\'gotoPage(\' + (page_index+1) + (next_cursor ? \',&quot;\' + next_cursor + \'&quot;\' : \'\') + \')\'" href="#0"><i class="uk-icon-angle-double-right"></i></a></li>' +
             '</ul>'
     });
 }
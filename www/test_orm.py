@@ -0,0 +1,232 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''
+    orm 的读写分离测试: 用 orm_sqlite 的连接池(与 aiomysql 用法相同)模拟一个主库和两个只读副本,
+    每个库是单独的数据库文件,表 src 的 name 中记录库的名称,据此判断查询发往了哪个库
+    以及查询合并、结果缓存在慢查询期间发生写入时不返回过期数据、旧数据 id 转换的测试
+    用法: python3 -m unittest test_orm  (或 pytest test_orm.py)
+'''
+
+import asyncio,os,shutil,sqlite3,tempfile,time,unittest
+import logging
+logging.disable(logging.WARNING)
+import orm,orm_sqlite,ids
+from models import Blog
+
+#替身后端: 主库和每个副本各用一个数据库文件; 查询出错(如表不存在)时视为副本故障
+class StandinBackend(orm.SQLiteBackend):
+    name = 'standin'
+    errors = (orm_sqlite.OperationalError,)
+
+    def __init__(self,paths):
+        self.paths = paths
+
+    async def open(self,loop,readers,sticky,kw):
+        writer = await orm_sqlite.create_pool(self.paths[kw['db']])
+        pools = []
+        for reader in readers:
+            pools.append((await orm_sqlite.create_pool(self.paths[reader['db']],maxsize=1,readonly=True),reader['db']))
+        return writer,kw['db'],pools,sticky
+
+#表 src 的模型,用 save_batched 写入
+class Source(orm.Model):
+    __table__ = 'src'
+    __writebehind__ = dict(delay=0.005,maxbatch=100,maxqueue=1000)
+    name = orm.StringField(primary_key=True)
+    note = orm.StringField()
+
+class ReplicaTest(unittest.IsolatedAsyncioTestCase):
+    STICKY = 0.3
+
+    async def asyncSetUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.paths = dict()
+        for name in ('writer','reader1','reader2'):
+            path = self.paths[name] = os.path.join(self.dir,'%s.db'%name)
+            conn = sqlite3.connect(path)
+            conn.execute('create table src(name text,note text)')
+            conn.execute('insert into src(name) values(?)',(name,))
+            conn.commit()
+            conn.close()
+        #只有主库有的表,在副本上查询会出错
+        conn = sqlite3.connect(self.paths['writer'])
+        conn.execute('create table only_writer(name text)')
+        conn.execute("insert into only_writer(name) values('writer')")
+        conn.commit()
+        conn.close()
+        orm._backends['standin'] = StandinBackend(self.paths)
+        await orm.create_pool(None,backend='standin',db='writer',readers=[dict(db='reader1'),dict(db='reader2')],sticky=self.STICKY)
+
+    async def asyncTearDown(self):
+        await orm.close_pool()
+        del orm._backends['standin']
+        shutil.rmtree(self.dir)
+
+    async def source(self,table='src'):
+        res = await orm.select('select name from %s'%table,(),coalesce=False)
+        return res[0]['name']
+
+    def readers(self):
+        return getattr(orm,'__readers')
+
+    def rows(self,name):
+        conn = sqlite3.connect(self.paths[name])
+        try:
+            return [r[0] for r in conn.execute('select name from src order by rowid')]
+        finally:
+            conn.close()
+
+    async def test_reads_round_robin_across_readers(self):
+        sources = [await self.source() for i in range(6)]
+        self.assertEqual(sorted(set(sources)),['reader1','reader2'])
+        self.assertTrue(all(a != b for a,b in zip(sources,sources[1:])))
+
+    async def test_failed_reader_falls_back_to_writer(self):
+        self.assertEqual(await self.source('only_writer'),'writer')
+        healthy = [r for r in self.readers() if r.healthy]
+        self.assertEqual(len(healthy),1)
+        #故障的副本在 retry 秒内不再使用,读请求都发往另一个副本
+        name = orm._pool_stats[healthy[0].pool].name
+        self.assertEqual(set([await self.source() for i in range(4)]),set([name]))
+        #没有健康的副本时读主库
+        healthy[0].mark_down()
+        self.assertEqual(await self.source(),'writer')
+
+    async def test_execute_goes_to_writer(self):
+        for i in range(4):
+            await orm.execute('insert into src(name) values(?)',['row%s'%i])
+        self.assertEqual(self.rows('writer'),['writer','row0','row1','row2','row3'])
+        self.assertEqual(self.rows('reader1'),['reader1'])
+        self.assertEqual(self.rows('reader2'),['reader2'])
+
+    async def test_session_reads_writer_after_write(self):
+        token = orm.bind_session('alice')
+        try:
+            self.assertIn(await self.source(),('reader1','reader2'))
+            await orm.execute('insert into src(name) values(?)',['alice'])
+            self.assertEqual(await self.source(),'writer')
+            self.assertEqual(await self.source(),'writer')
+            await asyncio.sleep(self.STICKY + 0.1)
+            self.assertIn(await self.source(),('reader1','reader2'))
+        finally:
+            orm._session.reset(token)
+
+    async def test_session_reads_writer_after_save_batched(self):
+        token = orm.bind_session('alice')
+        try:
+            self.assertIn(await self.source(),('reader1','reader2'))
+            await Source(name='alice').save_batched()
+            self.assertEqual(self.rows('writer'),['writer','alice'])
+            self.assertEqual(await self.source(),'writer')
+        finally:
+            orm._session.reset(token)
+
+    async def test_other_sessions_keep_reading_replicas(self):
+        token = orm.bind_session('alice')
+        await orm.execute('insert into src(name) values(?)',['alice'])
+        orm._session.reset(token)
+        token = orm.bind_session('bob')
+        try:
+            self.assertIn(await self.source(),('reader1','reader2'))
+        finally:
+            orm._session.reset(token)
+
+#查询执行后再等待 delay 秒返回,模拟慢查询: 返回的是开始时的数据
+def slow_select(delay):
+    execute = orm_sqlite.Cursor.execute
+    async def slow(self,sql,args=None):
+        res = await execute(self,sql,args)
+        if sql.lstrip().lower().startswith('select'):
+            await asyncio.sleep(delay)
+        return res
+    return execute,slow
+
+#查询合并与结果缓存: 写入之后的查询不会拿到写入之前开始的查询的结果
+class StaleReadTest(unittest.IsolatedAsyncioTestCase):
+    COUNT = 'select count(*) n from comments'
+
+    async def asyncSetUp(self):
+        self.dir = tempfile.mkdtemp()
+        schema = os.path.join(os.path.dirname(os.path.abspath(__file__)),'schema.sql')
+        await orm.create_pool(None,backend='sqlite',db=os.path.join(self.dir,'test.db'),schema=schema)
+        orm._results.clear()
+        self.execute,orm_sqlite.Cursor.execute = slow_select(0.2)
+
+    async def asyncTearDown(self):
+        orm_sqlite.Cursor.execute = self.execute
+        await orm.close_pool()
+        shutil.rmtree(self.dir)
+
+    async def insert_comment(self):
+        await orm.execute('insert into comments(id,blog_id,user_id,user_name,user_image,content,create_at)values (?,?,?,?,?,?,?)',[1,1,'u','user','image','content',time.time()])
+
+    async def count(self,cache):
+        res = await orm.select(self.COUNT,(),cache=cache)
+        return res[0]['n']
+
+    async def test_select_after_write_does_not_join_older_query(self):
+        first = asyncio.ensure_future(self.count(False))
+        await asyncio.sleep(0.05)
+        await self.insert_comment()
+        self.assertEqual(await self.count(False),1)
+        self.assertEqual(await first,0)
+
+    async def test_cached_select_after_write_is_not_stale(self):
+        first = asyncio.ensure_future(self.count(True))
+        await asyncio.sleep(0.05)
+        await self.insert_comment()
+        self.assertEqual(await self.count(True),1)
+        self.assertEqual(await first,0)
+        #之后命中缓存的结果也是写入之后的
+        self.assertEqual(await self.count(True),1)
+
+    async def test_find_after_update_is_not_stale(self):
+        blog = Blog(user_id='u',user_name='user',user_image='image',name='old',summary='summary',content='content')
+        await blog.save()
+        first = asyncio.ensure_future(Blog.find(blog.id))
+        await asyncio.sleep(0.05)
+        blog.name = 'new'
+        await blog.update()
+        self.assertEqual((await Blog.find(blog.id)).name,'new')
+        #第二次从行缓存读取
+        self.assertEqual((await Blog.find(blog.id)).name,'new')
+        self.assertEqual((await first).name,'old')
+
+#旧数据的字符串 id 转换为有序的整数 id
+class ConvertIdsTest(unittest.IsolatedAsyncioTestCase):
+    T = 1600000000.0
+
+    async def asyncSetUp(self):
+        self.dir = tempfile.mkdtemp()
+        path = os.path.join(self.dir,'test.db')
+        #转换之前的表结构: 字符串 id
+        with open(os.path.join(os.path.dirname(os.path.abspath(__file__)),'schema.sql')) as f:
+            schema = f.read().replace('id BIGINT','id VARCHAR(50)')
+        conn = sqlite3.connect(path)
+        for sql in orm_sqlite.translate_schema(schema):
+            conn.execute(sql)
+        #博客晚于它的评论,评论的新 id 不能取博客的时间
+        conn.execute('insert into blogs values(?,?,?,?,?,?,?,?)',('blog','u','user','image','name','summary','content',self.T + 1000))
+        for i in range(3):
+            conn.execute('insert into comments values(?,?,?,?,?,?,?)',('comment%s'%i,'blog','u','user','image','content',self.T + i))
+        conn.commit()
+        conn.close()
+        await orm.create_pool(None,backend='sqlite',db=path)
+
+    async def asyncTearDown(self):
+        await orm.close_pool()
+        shutil.rmtree(self.dir)
+
+    async def test_converted_ids_keep_create_at(self):
+        await ids.convert_ids(apply=True)
+        blogs = await orm.select('select id,create_at from blogs',(),cache=False)
+        comments = await orm.select('select id,blog_id,create_at from comments order by create_at',(),cache=False)
+        self.assertEqual(len(comments),3)
+        for r in blogs + comments:
+            self.assertAlmostEqual(orm.id_time(int(r['id'])),r['create_at'],places=2)
+        self.assertEqual([int(r['blog_id']) for r in comments],[int(blogs[0]['id'])] * 3)
+        self.assertEqual(sorted(int(r['id']) for r in comments),[int(r['id']) for r in comments])
+
+if __name__ == '__main__':
+    unittest.main()